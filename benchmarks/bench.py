@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmark pdfnup.generateNup on synthetic documents.
+
+Runs every combination of the given page counts, n values, contents
+and resource reuse modes (see synthpdf.py), each in a fresh process,
+and measures pages per second, peak memory (RSS) and output size.
+Results are written as JSON.
+
+With a baseline file (results of an earlier run) every case is also
+compared with its baseline and the script fails if pages per second
+have dropped, or peak RSS or output size have grown, by more than
+the threshold percentage.
+"""
+
+import concurrent.futures
+import getopt
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthpdf import generatePdf
+
+
+# metric: +1 if bigger is better, -1 if smaller is better
+METRICS = {"pages_per_sec": +1, "peak_rss_kb": -1, "output_bytes": -1}
+
+QUICK = {
+    "pages": [10, 1000],
+    "n": [2, 4, 18],
+    "content": ["text", "vector", "image"],
+    "reuse": ["shared", "copied"],
+}
+
+FULL = {
+    "pages": [10, 1000, 20000],
+    "n": [2, 4, 8, 18],
+    "content": ["text", "vector", "image"],
+    "reuse": ["shared", "copied", "unique"],
+}
+
+
+def caseKey(case):
+    "Return a string identifying a benchmark case."
+
+    return "pages={pages},n={n},content={content},reuse={reuse}".format(
+        **case)
+
+
+def _peakRss():
+    "Return the peak RSS of this process in kB."
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def _runCase(inPath, n, repeat):
+    "Run generateNup in this (fresh) process and return measurements."
+
+    import pdfnup
+
+    outPath = inPath[:-4] + f"-{n}up.pdf"
+    durations = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        numPages = pdfnup.generateNup(inPath, n, outPath)
+        durations.append(time.perf_counter() - start)
+    outputBytes = os.path.getsize(outPath)
+    os.remove(outPath)
+
+    return {
+        "seconds": min(durations),
+        "pages_per_sec": numPages / min(durations),
+        "peak_rss_kb": _peakRss(),
+        "output_bytes": outputBytes,
+    }
+
+
+def runBenchmarks(matrix, repeat=1, verbose=False):
+    "Run all cases of a matrix of parameters and return their results."
+
+    context = multiprocessing.get_context("spawn")
+    results = []
+    with tempfile.TemporaryDirectory() as tmpDir:
+        for numPages in matrix["pages"]:
+            for content in matrix["content"]:
+                for reuse in matrix["reuse"]:
+                    inPath = os.path.join(
+                        tmpDir, f"{numPages}-{content}-{reuse}.pdf")
+                    with open(inPath, "wb") as file:
+                        inputBytes = generatePdf(
+                            file, numPages, content, reuse)
+                    for n in matrix["n"]:
+                        case = {"pages": numPages, "n": n,
+                                "content": content, "reuse": reuse,
+                                "input_bytes": inputBytes}
+                        # a new process per case for a meaningful peak RSS
+                        with concurrent.futures.ProcessPoolExecutor(
+                                1, mp_context=context) as executor:
+                            future = executor.submit(
+                                _runCase, inPath, n, repeat)
+                            case.update(future.result())
+                        if verbose:
+                            print("%-50s %10.1f pages/s %8d kB %10d bytes" % (
+                                caseKey(case), case["pages_per_sec"],
+                                case["peak_rss_kb"], case["output_bytes"]),
+                                file=sys.stderr)
+                        results.append(case)
+
+    return results
+
+
+def compareResults(results, baseline, threshold):
+    """Compare results with baseline results.
+
+    Returns a list of messages, one per metric of a case that is more
+    than threshold percent worse than in the baseline.
+    """
+
+    baseline = {caseKey(case): case for case in baseline}
+    regressions = []
+    for case in results:
+        old = baseline.get(caseKey(case))
+        if old is None:
+            continue
+        for metric, sign in METRICS.items():
+            if not old.get(metric):
+                continue
+            change = (case[metric] - old[metric]) / old[metric] * 100
+            if -sign * change > threshold:
+                regressions.append("%s: %s %s -> %s (%+.1f%%)" % (
+                    caseKey(case), metric, old[metric], case[metric], change))
+
+    return regressions
+
+
+def _parseList(value, type=str):
+    return [type(v) for v in value.split(",")]
+
+
+def main(argv):
+    usage = f"""Usage: {os.path.basename(argv[0])} [options]
+
+Options:
+    -h --help           Show this help and exit.
+    --full              Run the full matrix (up to 20000 pages).
+    -p --pages LIST     Page counts, like 10,1000.
+    -n LIST             Number of pages per sheet, like 2,4,18.
+    -c --content LIST   Page contents: text, vector, image.
+    -r --reuse LIST     Resource reuse: shared, copied, unique.
+    --repeat NUM        Repeat every case NUM times, keep the fastest.
+    -o --output PATH    Write JSON results to PATH (default: stdout).
+    -b --baseline PATH  Compare with JSON results of an earlier run.
+    -t --threshold PCT  Allowed regression in percent (default: 10).
+    -v --verbose        Print results while running."""
+
+    shortOpts = "hp:n:c:r:o:b:t:v"
+    longOpts = ["help", "full", "pages=", "content=", "reuse=", "repeat=",
+                "output=", "baseline=", "threshold=", "verbose"]
+    try:
+        opts, args = getopt.getopt(argv[1:], shortOpts, longOpts)
+    except getopt.GetoptError as err:
+        print(err, file=sys.stderr)
+        print(usage, file=sys.stderr)
+        return 2
+
+    matrix = dict(QUICK)
+    repeat, outPath, baselinePath, threshold, verbose = 1, None, None, 10, False
+    for key, value in opts:
+        if key in ("-h", "--help"):
+            print(usage)
+            return 0
+        elif key == "--full":
+            matrix = dict(FULL)
+        elif key in ("-p", "--pages"):
+            matrix["pages"] = _parseList(value, int)
+        elif key == "-n":
+            matrix["n"] = _parseList(value, int)
+        elif key in ("-c", "--content"):
+            matrix["content"] = _parseList(value)
+        elif key in ("-r", "--reuse"):
+            matrix["reuse"] = _parseList(value)
+        elif key == "--repeat":
+            repeat = int(value)
+        elif key in ("-o", "--output"):
+            outPath = value
+        elif key in ("-b", "--baseline"):
+            baselinePath = value
+        elif key in ("-t", "--threshold"):
+            threshold = float(value)
+        elif key in ("-v", "--verbose"):
+            verbose = True
+
+    import pypdf
+
+    report = {
+        "python": platform.python_version(),
+        "pypdf": pypdf.__version__,
+        "platform": platform.platform(),
+        "results": runBenchmarks(matrix, repeat, verbose),
+    }
+    if outPath:
+        with open(outPath, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if baselinePath:
+        with open(baselinePath) as file:
+            baseline = json.load(file)["results"]
+        regressions = compareResults(report["results"], baseline, threshold)
+        for message in regressions:
+            print("regression:", message, file=sys.stderr)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
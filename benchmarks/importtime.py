@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Measure how long importing pdfnup takes, against a budget.
+
+Every measurement imports pdfnup in a fresh interpreter, using
+python -X importtime, and the fastest of some runs is reported as
+JSON, together with heavy modules (like pypdf) that were imported
+although they should only be imported on first use. The script fails
+if the import takes longer than the budget or loads heavy modules.
+"""
+
+import getopt
+import json
+import os
+import subprocess
+import sys
+
+
+# modules that must not be imported by "import pdfnup"
+HEAVY = ["pypdf", "asyncio", "concurrent.futures", "socketserver", "numpy"]
+
+CHECK = """\
+import sys
+import pdfnup
+print(" ".join(m for m in %r if m in sys.modules))
+""" % HEAVY
+
+
+def importTime(python=sys.executable):
+    "Return the import time of pdfnup in seconds and heavy modules loaded."
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    # the time to compile pdfnup.py once is not what we want to measure
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    proc = subprocess.run(
+        [python, "-X", "importtime", "-c", CHECK],
+        capture_output=True, text=True, env=env, check=True)
+    micros = None
+    for line in proc.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == "pdfnup":
+            micros = int(fields[1])
+    if micros is None:
+        raise RuntimeError("No import time found for pdfnup!")
+
+    return micros / 1e6, proc.stdout.split()
+
+
+def main(argv):
+    usage = f"""Usage: {os.path.basename(argv[0])} [options]
+
+Options:
+    -h --help           Show this help and exit.
+    -b --budget MS      Allowed import time in milliseconds (default: 50).
+    -r --runs NUM       Number of runs, the fastest counts (default: 10).
+    -o --output PATH    Write JSON results to PATH (default: stdout)."""
+
+    try:
+        opts, args = getopt.getopt(
+            argv[1:], "hb:r:o:", ["help", "budget=", "runs=", "output="])
+    except getopt.GetoptError as err:
+        print(err, file=sys.stderr)
+        print(usage, file=sys.stderr)
+        return 2
+
+    budget, runs, outPath = 50.0, 10, None
+    for key, value in opts:
+        if key in ("-h", "--help"):
+            print(usage)
+            return 0
+        elif key in ("-b", "--budget"):
+            budget = float(value)
+        elif key in ("-r", "--runs"):
+            runs = int(value)
+        elif key in ("-o", "--output"):
+            outPath = value
+
+    # the first run writes the bytecode cache
+    importTime()
+    results = [importTime() for i in range(runs)]
+    seconds = min(r[0] for r in results)
+    heavy = sorted(set(m for r in results for m in r[1]))
+    report = {
+        "import_ms": seconds * 1000,
+        "budget_ms": budget,
+        "heavy_modules": heavy,
+    }
+    if outPath:
+        with open(outPath, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if heavy:
+        print("imported eagerly:", ", ".join(heavy), file=sys.stderr)
+    if seconds * 1000 > budget:
+        print("import takes %.1f ms, more than %.1f ms" % (
+            seconds * 1000, budget), file=sys.stderr)
+    if heavy or seconds * 1000 > budget:
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Generate synthetic PDF documents for benchmarking pdfnup.
+
+The documents are written directly, without reportlab or pypdf, and
+without holding them in memory, so even very long ones are cheap to
+create. They vary in page count, page content and in how resources
+(a font and, optionally, an image) are shared between pages:
+
+- content "text": some lines of text per page,
+- content "vector": many stroked and filled paths per page,
+- content "image": an embedded RGB image plus a line of text,
+
+- reuse "shared": all pages refer to the same resource objects,
+- reuse "copied": every page has its own, but identical, copies,
+- reuse "unique": like "copied", but images differ from page to page.
+"""
+
+import random
+import sys
+import zlib
+
+
+CONTENTS = ("text", "vector", "image")
+REUSES = ("shared", "copied", "unique")
+
+FONT = b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+IMAGE_SIZE = 128
+
+
+def _stream(data, compress=True):
+    "Return a PDF stream object with some data."
+
+    if compress:
+        data = zlib.compress(data)
+        head = b"<< /Length %d /Filter /FlateDecode >>" % len(data)
+    else:
+        head = b"<< /Length %d >>" % len(data)
+
+    return head + b"\nstream\n" + data + b"\nendstream"
+
+
+def _image(seed):
+    "Return an image XObject, the same one for the same seed."
+
+    rnd = random.Random(seed)
+    a, b = rnd.randrange(256), rnd.randrange(256)
+    rows = []
+    for y in range(IMAGE_SIZE):
+        row = bytearray()
+        for x in range(IMAGE_SIZE):
+            row += bytes(((x * 2 + a) % 256, (y * 2 + b) % 256, (x ^ y) % 256))
+        rows.append(bytes(row))
+    data = zlib.compress(b"".join(rows))
+    head = (
+        b"<< /Type /XObject /Subtype /Image /Width %d /Height %d "
+        b"/ColorSpace /DeviceRGB /BitsPerComponent 8 "
+        b"/Length %d /Filter /FlateDecode >>"
+    ) % (IMAGE_SIZE, IMAGE_SIZE, len(data))
+
+    return head + b"\nstream\n" + data + b"\nendstream"
+
+
+def _content(i, content, pageSize):
+    "Return the content stream code of page i."
+
+    w, h = pageSize
+    code = [b"BT /F1 24 Tf 40 %d Td (Page %d) Tj ET" % (h - 60, i)]
+    if content == "text":
+        code.append(b"BT /F1 10 Tf 40 %d Td 12 TL" % (h - 100))
+        for j in range(int((h - 140) / 12)):
+            code.append(
+                b"(%d.%d The quick brown fox jumps over the lazy dog.) '"
+                % (i, j))
+        code.append(b"ET")
+    elif content == "vector":
+        rnd = random.Random(i)
+        for j in range(400):
+            x0, y0 = rnd.uniform(0, w), rnd.uniform(0, h - 80)
+            x1, y1 = rnd.uniform(0, w), rnd.uniform(0, h - 80)
+            code.append(b"%.2f %.2f %.2f rg %.2f %.2f m %.2f %.2f %.2f "
+                        b"%.2f %.2f %.2f c %s" % (
+                            rnd.random(), rnd.random(), rnd.random(),
+                            x0, y0, x1, y0, x0, y1, x1, y1,
+                            b"f" if j % 2 else b"S"))
+    elif content == "image":
+        code.append(b"q %d 0 0 %d 40 40 cm /Im1 Do Q" % (w - 80, h - 140))
+
+    return b"\n".join(code)
+
+
+def generatePdf(
+    outFile,
+    numPages,
+    content="text",
+    reuse="shared",
+    pageSize=(595, 842),
+):
+    """Write a synthetic PDF document to a binary file object.
+
+    Returns the number of bytes written.
+    """
+
+    if content not in CONTENTS:
+        raise ValueError(f"Unknown content: {content!r}")
+    if reuse not in REUSES:
+        raise ValueError(f"Unknown reuse: {reuse!r}")
+
+    withImage = content == "image"
+    # 1: catalog, 2: pages tree, 3/4: shared font/image
+    numShared = 1 + withImage if reuse == "shared" else 0
+    perPage = 2 + (0 if reuse == "shared" else 1 + withImage)
+    firstPage = 3 + numShared
+    pageNums = [firstPage + i * perPage for i in range(numPages)]
+    size = firstPage + numPages * perPage
+
+    offsets = [0] * size
+    pos = 0
+
+    def write(data):
+        nonlocal pos
+        outFile.write(data)
+        pos += len(data)
+
+    def writeObject(num, data):
+        offsets[num] = pos
+        write(b"%d 0 obj\n" % num + data + b"\nendobj\n")
+
+    write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    writeObject(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+    kids = b" ".join(b"%d 0 R" % num for num in pageNums)
+    writeObject(2, b"<< /Type /Pages /Count %d /Kids [%s] >>" % (
+        numPages, kids))
+    if reuse == "shared":
+        writeObject(3, FONT)
+        if withImage:
+            writeObject(4, _image(0))
+    image = _image(0) if reuse == "copied" and withImage else None
+
+    for i, num in enumerate(pageNums):
+        if reuse == "shared":
+            fontNum, imageNum = 3, 4
+        else:
+            fontNum, imageNum = num + 2, num + 3
+        resources = b"/Font << /F1 %d 0 R >>" % fontNum
+        if withImage:
+            resources += b" /XObject << /Im1 %d 0 R >>" % imageNum
+        writeObject(num, (
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] "
+            b"/Resources << %s >> /Contents %d 0 R >>"
+        ) % (pageSize[0], pageSize[1], resources, num + 1))
+        writeObject(num + 1, _stream(_content(i, content, pageSize)))
+        if reuse != "shared":
+            writeObject(fontNum, FONT)
+            if withImage:
+                writeObject(imageNum, image or _image(i))
+
+    xref = pos
+    write(b"xref\n0 %d\n0000000000 65535 f \n" % size)
+    for offset in offsets[1:]:
+        write(b"%010d 00000 n \n" % offset)
+    write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+          % (size, xref))
+
+    return pos
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(f"Usage: {sys.argv[0]} OUTPUT NUMPAGES [CONTENT [REUSE]]")
+        sys.exit(1)
+    with open(sys.argv[1], "wb") as file:
+        generatePdf(file, int(sys.argv[2]), *sys.argv[3:5])
@@ -15,24 +15,82 @@ For further information please look into the file README.txt!
 """
 
 
-import base64
+import array
+import bisect
+import collections
+import contextlib
+import functools
 import io
 import math
+import mmap
+import os
 import pathlib
+import re
+import threading
+import time
+import weakref
 import zlib
 
-try:
-    from pypdf import PdfWriter
-    from pypdf import PdfReader
-    from pypdf import PageObject
-    from pypdf.generic import NameObject
-    from pypdf.generic import DictionaryObject
-    from pypdf.generic import ArrayObject
-    from pypdf.generic import FloatObject
-    from pypdf.generic import ContentStream
-except ImportError:
-    print("Please install pyPdf first, see http://pybrary.net/pyPdf")
-    raise  # RuntimeError(_MSG)
+# pypdf is only imported when needed, see _importPypdf()
+_pypdfImported = False
+_pypdfNames = (
+    "PdfWriter", "PdfReader", "PageObject", "NameObject", "NumberObject",
+    "NullObject", "IndirectObject", "StreamObject", "DictionaryObject",
+    "ArrayObject", "FloatObject", "DecodedStreamObject",
+    "EncodedStreamObject", "_PlainName", "_EntryRef", "_pypdfVersion")
+
+
+def _importPypdf():
+    """Import the pypdf names used here into this module, once.
+
+    This is done on first use rather than at import time, so quick jobs
+    and tools only using the layout functions start up much faster.
+    """
+
+    global _pypdfImported
+    global PdfWriter, PdfReader, PageObject, NameObject, NumberObject
+    global NullObject, IndirectObject, StreamObject, DictionaryObject
+    global ArrayObject, FloatObject, DecodedStreamObject, EncodedStreamObject
+    global _PlainName, _EntryRef, _pypdfVersion
+    if _pypdfImported:
+        return
+
+    try:
+        from pypdf import __version__ as _pypdfVersion
+        from pypdf import PdfWriter
+        from pypdf import PdfReader
+        from pypdf import PageObject
+        from pypdf.generic import NameObject
+        from pypdf.generic import NumberObject
+        from pypdf.generic import NullObject
+        from pypdf.generic import IndirectObject
+        from pypdf.generic import StreamObject
+        from pypdf.generic import DictionaryObject
+        from pypdf.generic import ArrayObject
+        from pypdf.generic import FloatObject
+        from pypdf.generic import DecodedStreamObject
+        from pypdf.generic import EncodedStreamObject
+    except ImportError:
+        print("Please install pyPdf first, see http://pybrary.net/pyPdf")
+        raise  # RuntimeError(_MSG)
+
+    # subclasses of pypdf classes, defined here but at module level, so
+    # their instances can be pickled like those of their base classes
+
+    class _PlainName(NameObject):
+        "A name which needs no escaping, so is written quickly."
+
+        def write_to_stream(self, stream, encryption_key=None):
+            stream.write(self.encode("ascii"))
+
+    class _EntryRef(IndirectObject):
+        "A reference recording where it is written, for renumbering it."
+
+        def write_to_stream(self, stream, encryption_key=None):
+            self.pdf.positions.append((stream.tell(), self.idnum))
+            stream.write(b"%d 0 R" % self.idnum)
+
+    _pypdfImported = True
 
 
 __version__ = "0.4.1"
@@ -60,7 +118,27 @@ ZmFwL+aYJQ6ZkCimSVbxsI8eQK30MVj8+WNwdISXF3YINutfW1pBXdfZ1DHNqe26/eOpbTvx1Pba
 U7ttv8WBNTUtGx8HH6v2XwP+V/YNqF1F0eoEe8Wth1cHuPnbOPpKobPpJ5LIbLMsx1PfvdrpG7z6
 fgMis+cW
 """
-_mtA4Pdf = zlib.decompress(base64.standard_b64decode(_mtA4PdfZip64))
+
+
+@functools.lru_cache(maxsize=None)
+def _mtA4PdfCode():
+    "Return the PDF code of one empty A4 page, decoding it on first use."
+
+    import base64
+
+    return zlib.decompress(base64.standard_b64decode(_mtA4PdfZip64))
+
+
+def __getattr__(name):
+    "Load some module attributes on first use."
+
+    if name == "_mtA4Pdf":
+        return _mtA4PdfCode()
+    if name in _pypdfNames:
+        _importPypdf()
+        return globals()[name]
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def isSquare(n):
@@ -94,57 +172,25 @@ def calcScalingFactors(w, h, wp, hp):
     return xscale, yscale
 
 
-def calcRects(pageSize, numTiles, dirs="RD"):
-    "Return list of sub rects for some rect."
+def calcGridRects(pageSize, rows, cols, dirs="RD"):
+    "Return list of sub rects for some rect, divided into rows x cols."
 
     allowdDirs = [x+y for x in "RL" for y in "UD"]
     allowdDirs += [y+x for x in "RL" for y in "UD"]
     assert dirs in allowdDirs
 
     width, height = pageSize
-    n = numTiles
-    xDir, yDir = dirs
-
-    if isSquare(n):
-        s = math.sqrt(n)
-        w, h = float(width)/float(s), float(height)/float(s)
-        if "R" in dirs:
-            xr = range(0, int(s))
-        elif "L" in dirs:
-            xr = range(int(s)-1, -1, -1)
-        if "D" in dirs:
-            yr = range(int(s)-1, -1, -1)
-        elif "U" in dirs:
-            yr = range(0, int(s))
-        xs = [i*w for i in xr]
-        ys = [j*h for j in yr]
-    elif isHalfSquare(n):
-        # should issue a warning for page ratios different from 1:sqr(2)
-        s = math.sqrt(2*n)
-        if width > height:
-            w, h = float(width)/float(s), float(height)/float(s)*2
-            if "R" in dirs:
-                xr = range(0, int(s))
-            elif "L" in dirs:
-                xr = range(int(s)-1, -1, -1)
-            if "D" in dirs:
-                yr = range(int(s/2)-1, -1, -1)
-            elif "U" in dirs:
-                yr = range(0, int(s/2))
-            xs = [i*w for i in xr]
-            ys = [j*h for j in yr]
-        else:
-            w, h = float(width)/float(s)*2, float(height)/float(s)
-            if "R" in dirs:
-                xr = range(0, int(s/2))
-            elif "L" in dirs:
-                xr = range(int(s/2)-1, -1, -1)
-            if "D" in dirs:
-                yr = range(int(s)-1, -1, -1)
-            elif "U" in dirs:
-                yr = range(0, int(s))
-            xs = [i*w for i in xr]
-            ys = [j*h for j in yr]
+    w, h = float(width)/cols, float(height)/rows
+    if "R" in dirs:
+        xr = range(0, cols)
+    elif "L" in dirs:
+        xr = range(cols-1, -1, -1)
+    if "D" in dirs:
+        yr = range(rows-1, -1, -1)
+    elif "U" in dirs:
+        yr = range(0, rows)
+    xs = [i*w for i in xr]
+    ys = [j*h for j in yr]
 
     # decide order (first x, then y or first y then x)
     if dirs in "RD LD RU LU".split():
@@ -155,9 +201,55 @@ def calcRects(pageSize, numTiles, dirs="RD"):
     return rects
 
 
+def _halfSquareShape(sheetSize, n):
+    "Return rows and columns for a half square number n on some sheet."
+
+    # should issue a warning for page ratios different from 1:sqr(2)
+    width, height = sheetSize
+    s = int(round(math.sqrt(2*n)))
+    if width > height:
+        return s // 2, s
+    else:
+        return s, s // 2
+
+
+def calcGrid(pageSize, n):
+    """Return sheet size, rows and columns for n tiles per sheet.
+
+    n is either a square or half square number, or a (rows, cols)
+    tuple. For half square numbers the sheet is turned by 90 degrees.
+    """
+
+    if isinstance(n, tuple):
+        rows, cols = n
+        assert rows > 0 and cols > 0
+        return pageSize, rows, cols
+    elif isSquare(n):
+        s = int(round(math.sqrt(n)))
+        return pageSize, s, s
+    elif isHalfSquare(n):
+        sheetSize = pageSize[1], pageSize[0]
+        return (sheetSize, *_halfSquareShape(sheetSize, n))
+
+    raise AssertionError("n must be a square or half square number!")
+
+
+def calcRects(pageSize, numTiles, dirs="RD"):
+    "Return list of sub rects for some rect."
+
+    if isSquare(numTiles):
+        rows = cols = int(round(math.sqrt(numTiles)))
+    elif isHalfSquare(numTiles):
+        rows, cols = _halfSquareShape(pageSize, numTiles)
+
+    return calcGridRects(pageSize, rows, cols, dirs)
+
+
 def exP1multiN(pdf, newPageSize, n):
     "Extract page 1 of a PDF file, copy it n times resized."
 
+    _importPypdf()
+
     # create a file-like buffer object containing PDF code
     buf = io.BytesIO()
     buf.write(pdf)
@@ -180,159 +272,3516 @@ def exP1multiN(pdf, newPageSize, n):
     return buf2
 
 
-def generateNup(
-    inPathOrFile: io.IOBase | pathlib.Path | str,
-    n: int,
-    outPathPatternOrFile: io.IOBase | pathlib.Path | str | None = None,
-    dirs="RD",
-    verbose: bool = False,
-):
-    """Generate a N-up document version.
+# output profiles, trading CPU time for output size: zlib level of new
+# streams (None for no compression), whether uncompressed source streams
+# are compressed, too, decimals of numbers in new content streams (None
+# for full precision) and whether objects are packed in object streams,
+# with a compressed cross-reference stream
+OUTPUT_PROFILES = {
+    "fast": {"level": None, "recompress": False, "precision": None,
+             "objectStreams": False},
+    "balanced": {"level": 6, "recompress": False, "precision": 4,
+                 "objectStreams": False},
+    "small": {"level": 9, "recompress": True, "precision": 3,
+              "objectStreams": True},
+}
 
-    If outPathPatternOrFile is None, the output will be written
-    in a file named after the input file.
+
+def _outputProfile(profile, precision=None):
+    "Return the settings of an output profile, overriding its precision."
+
+    try:
+        settings = dict(OUTPUT_PROFILES[profile])
+    except KeyError:
+        raise ValueError(f"Unknown output profile: {profile!r}") from None
+    if precision is not None:
+        settings["precision"] = precision
+
+    return settings
+
+
+# names written as they are, with no character escaped as #xx, as a
+# _PlainName
+_plainName = re.compile(r"/[!\"$&'*+,\-.\w:;=?@\\^`|~]*\Z", re.ASCII)
+
+
+def _name(name):
+    """Return a NameObject for some name.
+
+    Written objects are mostly names, and pypdf escapes them character
+    by character, while most names need no escaping at all.
     """
 
-    assert isSquare(n) or isHalfSquare(n)
+    if _plainName.match(name):
+        return _PlainName(name)
 
-    if isinstance(inPathOrFile, str):
-        inPathOrFile = pathlib.Path(inPathOrFile)
+    return NameObject(name)
 
-    inFile = inPathOrFile
-    outFile = outPathPatternOrFile
 
-    if outPathPatternOrFile is None:
-        if isinstance(inPathOrFile, pathlib.Path):
-            outFile = inPathOrFile.parent / f"{inPathOrFile.stem}-{n}up{inPathOrFile.suffix}"
-        else:
-            raise AssertionError("Must specify output for file input!")
-    elif isinstance(outPathPatternOrFile, str):
-        outFile = pathlib.Path(outPathPatternOrFile)
+def _streamObject(data, level=None):
+    "Return a new stream object with some data, compressed if level is set."
 
-    # get info about source document
-    if isinstance(inFile, io.IOBase):
-        docReader = PdfReader(inFile)
+    if level is None:
+        stream = DecodedStreamObject()
+        stream.set_data(data)
     else:
-        with inFile.open('rb') as file:
-            docReader = PdfReader(inFile)
-    numPages = len(docReader.pages)
-    oldPageSize = docReader.pages[0].mediabox.upper_right
-
-    # create empty output document buffer
-    if isSquare(n):
-        newPageSize = oldPageSize
-    elif isHalfSquare(n):
-        newPageSize = oldPageSize[1], oldPageSize[0]
-    np = numPages // n + numPages % n
-    buf = exP1multiN(_mtA4Pdf, newPageSize, np)
-
-    # calculate mini page areas
-    rects = calcRects(newPageSize, n, dirs)
-
-    # combine
-    mapping = {}
-    # newPageNum = -1
-    for i in range(numPages):
-        # if i % n == 0:
-        #     newPageNum += 1
-        destPageNum = i//n
-        op = (inPathOrFile, i, (0, 0, None, None), destPageNum, rects[i % n])
-        if destPageNum not in mapping:
-            mapping[destPageNum] = []
-        mapping[destPageNum].append(op)
-
-    if isinstance(inFile, io.IOBase):
-        srcr = PdfReader(inFile)
+        stream = EncodedStreamObject()
+        stream._data = zlib.compress(data, level)
+        stream[_name("/Filter")] = _name("/FlateDecode")
+
+    return stream
+
+
+def _pageAsFormXObject(page, pool):
+    """Wrap a page's raw content stream and resources as a Form XObject.
+
+    The resources are copied into the output document by a resource
+    pool, once per distinct object, no matter how many pages share them.
+    """
+
+    contents = page.get("/Contents")
+    if contents is not None:
+        contents = contents.get_object()
+    if isinstance(contents, ArrayObject):
+        # a Form XObject has a single stream, so concatenate the parts,
+        # compressing them again if any of them was compressed
+        parts = [part.get_object() for part in contents]
+        data = b"\n".join(part.get_data() for part in parts)
+        level = pool.recompress
+        if level is None and any("/Filter" in part for part in parts):
+            level = pool.profile["level"]
+            if level is None:
+                level = zlib.Z_BEST_SPEED
+        form = _streamObject(data, level)
+    elif contents is not None and "/Filter" in contents:
+        # keep the data as it is, still compressed
+        form = EncodedStreamObject()
+        form._data = contents._data
+        for key in ("/Filter", "/DecodeParms"):
+            if key in contents:
+                form[_name(key)] = contents[key]
     else:
-        with inFile.open('rb') as file:
-            srcr = PdfReader(inFile)
+        data = b"" if contents is None else contents.get_data()
+        form = _streamObject(data, pool.recompress)
 
-    outr = PdfReader(buf)
-    output = PdfWriter()
+    form[_name("/Type")] = _name("/XObject")
+    form[_name("/Subtype")] = _name("/Form")
+    form[_name("/BBox")] = ArrayObject(
+        FloatObject(x) for x in page.mediabox)
+    resources = page.get("/Resources", DictionaryObject())
+    form[_name("/Resources")] = pool.importObject(resources)
 
-    for destPageNum, ops in mapping.items():
-        for op in ops:
-            inPathOrFile, srcPageNum, srcRect, destPageNum, destRect = op
-            page2 = srcr.pages[srcPageNum]
-            page1 = outr.pages[destPageNum]
-            pageWidth, pageHeight = page2.mediabox.upper_right
-            destX, destY, destWidth, destHeight = destRect
-            xScale, yScale = calcScalingFactors(
-                destWidth, destHeight, pageWidth, pageHeight)
-
-            newResources = DictionaryObject()
-            rename = {}
-            orgResources = page1["/Resources"].get_object()
-            page2Resources = page2["/Resources"].get_object()
-
-            names = "ExtGState Font XObject ColorSpace Pattern Shading"
-            for res in names.split():
-                res = "/" + res
-                new, newrename = PageObject._merge_resources(
-                    orgResources,
-                    page2Resources,
-                    res
-                )
-                if new:
-                    newResources[NameObject(res)] = new
-                    rename.update(newrename)
-
-            newResources[NameObject("/ProcSet")] = ArrayObject(
-                frozenset(
-                    orgResources.get("/ProcSet", ArrayObject()).get_object()
-                ).union(
-                    frozenset(
-                        page2Resources.get("/ProcSet", ArrayObject()).get_object()
-                    )
-                )
-            )
-
-            newContentArray = ArrayObject()
-            orgContent = page1["/Contents"].get_object()
-            newContentArray.append(PageObject._push_pop_gs(orgContent, page1.pdf))
-            page2Content = page2['/Contents'].get_object()
-            page2Content = PageObject._content_stream_rename(
-                page2Content,
-                rename,
-                page1.pdf
-            )
-            page2Content = ContentStream(page2Content, page1.pdf)
-            page2Content.operations.insert(0, [[], "q"])
-
-            # handle rotation
-            try:
-                rotation = page2["/Rotate"].get_object()
-            except KeyError:
-                rotation = 0
-            if rotation in (180, 270):
-                dw, dh = destWidth, destHeight
-                arr = [-xScale, 0, 0, -yScale, destX+dw, destY+dh]
-            elif rotation in (0, 90):
-                arr = [xScale, 0, 0, yScale, destX, destY]
-            else:
-                # treat any other (illegal) rotation as 0
-                arr = [xScale, 0, 0, yScale, destX, destY]
-
-            arr = [FloatObject(str(x)) for x in arr]
-            page2Content.operations.insert(1, [arr, "cm"])
-            page2Content.operations.append([[], "Q"])
-            newContentArray.append(page2Content)
-            page1[NameObject('/Contents')] = ContentStream(
-                newContentArray,
-                page1.pdf
-            )
-            page1[NameObject('/Resources')] = newResources
+    return form
 
-        output.add_page(page1)
 
-    if isinstance(outFile, io.IOBase):
-        output.write(outFile)
+def _placeFormXObject(name, matrix, precision=None):
+    "Return content stream code drawing a Form XObject with some matrix."
+
+    nums = " ".join(_formatNumber(x, precision) for x in matrix)
+
+    return f"q {nums} cm {name} Do Q\n".encode("latin-1")
+
+
+def _formatNumber(x, precision=None):
+    "Format a number for PDF content stream code, maybe rounded."
+
+    if precision is not None:
+        x = round(x, precision)
+    if x == int(x):
+        return str(int(x))
+    if precision is not None:
+        return ("%.*f" % (precision, x)).rstrip("0")
+
+    text = repr(float(x))
+    if "e" in text:
+        # PDF has no exponent notation
+        text = ("%.17f" % x).rstrip("0")
+
+    return text
+
+
+def _composeSheet(pageSize, tiles, pdf, level=None, precision=None):
+    """Return a new sheet drawing some Form XObjects.
+
+    The tiles are (name, form, matrix) tuples, and the sheet's contents
+    and resources are written exactly once, after collecting all tiles.
+    The contents are compressed at some zlib level, if given, and the
+    numbers in it rounded to some precision, if given.
+    """
+
+    xObjects = DictionaryObject()
+    code = []
+    for name, form, matrix in tiles:
+        xObjects[name] = form
+        code.append(_placeFormXObject(name, matrix, precision))
+
+    contents = _streamObject(b"".join(code), level)
+    resources = DictionaryObject()
+    resources[_name("/XObject")] = xObjects
+
+    sheet = PageObject.create_blank_page(None, *pageSize)
+    sheet[_name("/Resources")] = resources
+    sheet[_name("/Contents")] = pdf._add_object(contents)
+
+    return sheet
+
+
+class NupPlan:
+    """A precomputed N-up layout, as returned by plan_nup().
+
+    For every tile, i.e. placement of a source page on a sheet, a plan
+    holds the source page number, the sheet number, the tile rect
+    (x, y, w, h) and the transformation matrix (a, b, c, d, e, f) that
+    maps the source page into the tile. These are kept in flat arrays,
+    ordered by sheet, so even plans for many thousand pages are small
+    and cheap to pass to other processes.
+    """
+
+    def __init__(self, n, dirs, sheetSize, numPages):
+        self.n = n
+        self.dirs = dirs
+        self.sheetSize = sheetSize
+        self.numPages = numPages
+        self.pages = array.array("l")
+        self.sheets = array.array("l")
+        self.rects = array.array("d")
+        self.matrices = array.array("d")
+
+    def __len__(self):
+        return len(self.pages)
+
+    @property
+    def numSheets(self):
+        return self.sheets[-1] + 1 if self.sheets else 0
+
+    def addTile(self, page, sheet, rect, matrix):
+        "Add a tile, after all tiles of previous sheets."
+
+        self.pages.append(page)
+        self.sheets.append(sheet)
+        self.rects.extend(rect)
+        self.matrices.extend(matrix)
+
+    def tile(self, i):
+        "Return a (page, sheet, rect, matrix) tuple for the i-th tile."
+
+        rect = tuple(self.rects[4*i:4*i+4])
+        matrix = tuple(self.matrices[6*i:6*i+6])
+
+        return self.pages[i], self.sheets[i], rect, matrix
+
+    def sheetTiles(self, firstSheet=0, lastSheet=None):
+        "Yield (sheet, tile indices) for a range of sheets."
+
+        start = bisect.bisect_left(self.sheets, firstSheet)
+        if lastSheet is None:
+            end = len(self.sheets)
+        else:
+            end = bisect.bisect_left(self.sheets, lastSheet)
+        while start < end:
+            sheet = self.sheets[start]
+            stop = bisect.bisect_right(self.sheets, sheet, start, end)
+            yield sheet, range(start, stop)
+            start = stop
+
+
+# use NumPy for computing transforms of documents with at least this
+# many pages, if it is installed
+_vectorizeMinPages = 256
+
+
+def _quarterTurns(rotation):
+    "Return number of clockwise quarter turns, treating illegal ones as 0."
+
+    if rotation % 90 != 0:
+        return 0
+
+    return (rotation // 90) % 4
+
+
+def _rotationBase(q, x0, y0, w, h):
+    """Return the matrix mapping a page's mediabox onto its displayed box.
+
+    The page is turned by q clockwise quarter turns, like for /Rotate,
+    and the displayed box has its origin at (0, 0). The values can be
+    floats or NumPy arrays.
+    """
+
+    if q == 0:
+        return 1, 0, 0, 1, -x0, -y0
+    elif q == 1:
+        return 0, -1, 1, 0, -y0, w + x0
+    elif q == 2:
+        return -1, 0, 0, -1, w + x0, h + y0
     else:
-        with outFile.open('wb') as file:
-            output.write(file)
+        return 0, 1, -1, 0, h + y0, -x0
 
-    if verbose:
-        print("written to file-like input parameter")
-        # if isinstance(oppof, str):
-        #     print(f"written: {outPath.name}")
-        # elif isinstance(oppof, io.IOBase):
+
+def _displaySize(geometry):
+    "Return displayed width and height of a (x0, y0, x1, y1, rotation) box."
+
+    x0, y0, x1, y1, rotation = geometry
+    if _quarterTurns(rotation) % 2:
+        return y1 - y0, x1 - x0
+
+    return x1 - x0, y1 - y0
+
+
+def _normalizeGeometry(geometry):
+    "Return a (x0, y0, x1, y1, rotation) tuple for some page geometry."
+
+    if len(geometry) == 3:
+        width, height, rotation = geometry
+        return 0.0, 0.0, float(width), float(height), int(rotation)
+
+    x0, y0, x1, y1, rotation = geometry
+
+    return float(x0), float(y0), float(x1), float(y1), int(rotation)
+
+
+@functools.lru_cache(maxsize=1024)
+def _tileMatrix(geometry, rect, fit):
+    """Return the matrix placing a page with some geometry into a rect.
+
+    The page is shown as with its /Rotate value, scaled to the rect,
+    either stretched to fill it, or keeping its aspect ratio (fit) and
+    centered.
+    """
+
+    x0, y0, x1, y1, rotation = geometry
+    w, h = x1 - x0, y1 - y0
+    q = _quarterTurns(rotation)
+    dispWidth, dispHeight = (h, w) if q % 2 else (w, h)
+    rx, ry, rw, rh = rect
+    sx, sy = rw / dispWidth, rh / dispHeight
+    if fit:
+        sx = sy = min(sx, sy)
+        rx += (rw - sx * dispWidth) / 2
+        ry += (rh - sy * dispHeight) / 2
+
+    a, b, c, d, e, f = _rotationBase(q, x0, y0, w, h)
+
+    return sx*a, sy*b, sx*c, sy*d, sx*e + rx, sy*f + ry
+
+
+def _tileMatrices(geometries, slotRects, pages, slots, fit):
+    """Return a flat list of matrices for placing pages into slots.
+
+    This is done in one vectorized batch if NumPy is available and
+    there are many pages, else page by page with cached results.
+    """
+
+    numpy = _numpy() if len(pages) >= _vectorizeMinPages else None
+    if numpy is None:
+        matrices = []
+        for page, slot in zip(pages, slots):
+            matrices.extend(
+                _tileMatrix(geometries[page], slotRects[slot], fit))
+        return matrices
+
+    geoms = numpy.array(geometries, dtype=float)[numpy.asarray(pages)]
+    rects = numpy.array(slotRects, dtype=float)[numpy.asarray(slots)]
+    x0, y0, x1, y1, rotation = geoms.T
+    w, h = x1 - x0, y1 - y0
+    rotation = rotation.astype(int)
+    q = numpy.where(rotation % 90 == 0, (rotation // 90) % 4, 0)
+    odd = q % 2 == 1
+    dispWidth, dispHeight = numpy.where(odd, h, w), numpy.where(odd, w, h)
+    rx, ry, rw, rh = rects.T
+    sx, sy = rw / dispWidth, rh / dispHeight
+    if fit:
+        sx = sy = numpy.minimum(sx, sy)
+        rx = rx + (rw - sx * dispWidth) / 2
+        ry = ry + (rh - sy * dispHeight) / 2
+
+    bases = [_rotationBase(i, x0, y0, w, h) for i in range(4)]
+    conditions = [q == i for i in range(4)]
+    a, b, c, d, e, f = (
+        numpy.select(conditions, [base[j] for base in bases])
+        for j in range(6))
+    matrices = numpy.stack([sx*a, sy*b, sx*c, sy*d, sx*e + rx, sy*f + ry])
+
+    return matrices.T.ravel().tolist()
+
+
+@functools.lru_cache(maxsize=None)
+def _numpy():
+    "Return the numpy module, or None if it is not installed."
+
+    try:
+        import numpy
+    except ImportError:
+        return None
+
+    return numpy
+
+
+def plan_nup(page_geometries, n, dirs="RD", fit=False):
+    """Return a NupPlan placing n pages per sheet.
+
+    page_geometries is a sequence with a (x0, y0, x1, y1, rotation)
+    tuple of the mediabox and /Rotate value for every source page, as
+    returned by pageGeometries(), or simply (width, height, rotation).
+    n is a square or half square number, or a (rows, cols) tuple for
+    any other grid. Pages of any size and rotation are scaled to their
+    tiles, either stretched or, if fit is True, keeping their aspect
+    ratio. The sheet size is the displayed size of the first page.
+
+    All tile transforms are computed in one batch, with NumPy if it is
+    available, else with results cached by page size, rotation and
+    tile. The plan can be passed to generateNup() for any document
+    with the same page geometries.
+    """
+
+    if not page_geometries:
+        raise ValueError("Cannot plan a document without pages!")
+
+    geometries = [_normalizeGeometry(g) for g in page_geometries]
+    plan, slotRects = _emptyPlan(geometries[0], n, dirs, len(geometries))
+    _addTiles(plan, geometries, slotRects, fit)
+
+    return plan
+
+
+def _emptyPlan(geometry, n, dirs, numPages):
+    """Return a NupPlan without tiles and its slot rects.
+
+    The sheet size is the displayed size of a page with the geometry
+    of the first page.
+    """
+
+    sheetSize, rows, cols = calcGrid(_displaySize(geometry), n)
+    slotRects = calcGridRects(sheetSize, rows, cols, dirs)
+
+    return NupPlan(rows * cols, dirs, sheetSize, numPages), slotRects
+
+
+def _addTiles(plan, geometries, slotRects, fit):
+    """Add tiles for the next pages to a plan.
+
+    The geometries of these pages are normalized. Tiles only depend on
+    the sheet size and the page placed, so plans can be made in parts.
+    """
+
+    start, numTiles = len(plan), plan.n
+    nums = range(start, start + len(geometries))
+    plan.pages.extend(nums)
+    plan.sheets.extend(i // numTiles for i in nums)
+    slots = [i % numTiles for i in nums]
+    for slot in slots:
+        plan.rects.extend(slotRects[slot])
+    plan.matrices.extend(_tileMatrices(
+        geometries, slotRects, range(len(geometries)), slots, fit))
+
+
+class _PageTree:
+    """Random access to the pages of a document, resolving them lazily.
+
+    Unlike reader.pages, which flattens the whole page tree on first
+    use, only the page tree nodes on the way to a requested page and
+    the page itself are resolved. Intermediate nodes are cached with
+    the page numbers their kids start at and their inheritable
+    attributes. Pages are not cached, unlike in reader.pages, so they
+    can be dropped once used, keeping memory bounded while streaming.
+    """
+
+    inheritable = ("/Resources", "/MediaBox", "/CropBox", "/Rotate")
+
+    def __init__(self, reader):
+        _importPypdf()
+        self.reader = reader
+        self.rootRef = reader.trailer["/Root"].get_object().raw_get("/Pages")
+        self.nodes = {}
+        root = self.rootRef.get_object()
+        if "/Kids" in root:
+            self.numPages = int(root.get("/Count", 0))
+        else:
+            self.numPages = 1
+
+    def __len__(self):
+        return self.numPages
+
+    def _node(self, ref, inherited):
+        """Return kids, start page numbers and inherited values of a node.
+
+        Return None if the node is a page. The start page numbers are
+        None if the node has as many pages as kids, so its kids are
+        likely all pages, which _find() checks as needed. Page tree
+        nodes are cached and looked up without resolving them again,
+        as the reader's cache of resolved objects may be cleared while
+        streaming.
+        """
+
+        key = ref.idnum if isinstance(ref, IndirectObject) else id(ref)
+        entry = self.nodes.get(key)
+        if entry is not None:
+            return entry
+
+        node = ref.get_object()
+        if "/Kids" not in node:
+            return None
+        kids = node["/Kids"]
+        inherited = dict(inherited)
+        for name in self.inheritable:
+            if name in node:
+                inherited[name] = node.raw_get(name)
+        if int(node.get("/Count", -1)) == len(kids):
+            starts = None
+        else:
+            starts = self._starts(kids)
+        # the last item counts the leading kids known to be pages
+        entry = self.nodes[key] = [kids, starts, inherited, 0]
+
+        return entry
+
+    def _starts(self, kids):
+        "Return the page numbers the kids of a node start at."
+
+        starts, start = [], 0
+        for kid in kids:
+            starts.append(start)
+            count = self._kidCount(kid)
+            start += 1 if count is None else count
+
+        return starts
+
+    def _kidCount(self, kid, keep=False):
+        """Return the /Count of a kid, or None if it is a page.
+
+        Unless keep is set, a kid resolved only for this is dropped
+        again, so that checking many kids does not keep them all in
+        memory.
+        """
+
+        resolved = self.reader.resolved_objects
+        kidKey = None
+        if not keep and isinstance(kid, IndirectObject):
+            kidKey = kid.generation, kid.idnum
+            if kidKey in resolved:
+                kidKey = None
+        obj = kid.get_object()
+        if kidKey is not None:
+            resolved.pop(kidKey, None)
+
+        return int(obj.get("/Count", 0)) if "/Kids" in obj else None
+
+    def __getitem__(self, i):
+        "Return page i."
+
+        return self._page(*self._find(i))
+
+    def geometry(self, i):
+        "Return the (x0, y0, x1, y1, rotation) tuple of page i."
+
+        ref, inherited = self._find(i)
+        obj = ref.get_object()
+        mediabox = obj.get("/MediaBox", inherited.get("/MediaBox"))
+        x0, y0, x1, y1 = (float(x) for x in mediabox.get_object())
+        rotation = obj.get("/Rotate", inherited.get("/Rotate"))
+        rotation = 0 if rotation is None else int(rotation.get_object())
+
+        return x0, y0, x1, y1, rotation
+
+    def _find(self, i):
+        """Return page i and the values it inherits.
+
+        This descends the page tree to the page.
+        """
+
+        if not 0 <= i < self.numPages:
+            raise IndexError("Page index out of range!")
+
+        ref, inherited = self.rootRef, {}
+        for depth in range(64):
+            entry = self._node(ref, inherited)
+            if entry is None:
+                return ref, inherited
+            kids, starts, kidsInherit, checked = entry
+            if starts is None:
+                # kid i is page i if it and all kids before it are pages
+                while checked <= i and i < len(kids) and self._kidCount(
+                        kids[checked], checked == i) is None:
+                    checked += 1
+                entry[3] = checked
+                if checked > i:
+                    return kids[i], kidsInherit
+                starts = entry[1] = self._starts(kids)
+            k = bisect.bisect_right(starts, i) - 1
+            ref, i, inherited = kids[k], i - starts[k], kidsInherit
+
+        raise ValueError("Page tree is too deep or has a cycle!")
+
+    def _page(self, ref, inherited):
+        "Return a PageObject for a page and the values it inherits."
+
+        obj = ref.get_object()
+        page = PageObject(self.reader, ref if isinstance(
+            ref, IndirectObject) else None)
+        page.update(obj)
+        for name, value in inherited.items():
+            if name not in page:
+                page[NameObject(name)] = value
+
+        return page
+
+
+def select_pages(spec, numPages):
+    """Return the 0-based numbers of the pages chosen by some selection.
+
+    spec is None for all pages, a range, slice or other iterable of
+    0-based page numbers, or a string of comma-separated 1-based page
+    numbers and ranges as used on the command-line. A range "A-B" may
+    omit A or B for the first or last page, is reversed if A > B, and
+    may be followed by a step, as in "1-100:2" for the odd pages.
+    """
+
+    if spec is None:
+        return range(numPages)
+    elif isinstance(spec, slice):
+        return range(*spec.indices(numPages))
+    elif not isinstance(spec, str):
+        nums = list(spec)
+        for num in nums:
+            if not 0 <= num < numPages:
+                raise ValueError(f"Page number out of range: {num}")
+        return nums
+
+    nums = []
+    for part in spec.replace(" ", "").split(","):
+        part, _, step = part.partition(":")
+        first, sep, last = part.partition("-")
+        try:
+            step = int(step) if step else 1
+            first = int(first) if first else 1
+            last = int(last) if last else (numPages if sep else first)
+        except ValueError:
+            raise ValueError(f"Invalid page selection: {spec!r}") from None
+        if step < 1 or not part:
+            raise ValueError(f"Invalid page selection: {spec!r}")
+        for num in (first, last):
+            if not 1 <= num <= numPages:
+                raise ValueError(f"Page number out of range: {num}")
+        if first <= last:
+            nums.extend(range(first - 1, last, step))
+        else:
+            nums.extend(range(first - 1, last - 2, -step))
+
+    return nums
+
+
+def pageGeometries(reader, pages=None):
+    """Return a (x0, y0, x1, y1, rotation) tuple for pages of a reader.
+
+    This is done for every page, or for the pages selected by pages as
+    described for select_pages().
+    """
+
+    _importPypdf()
+    tree = _PageTree(reader)
+
+    return _geometries(tree, select_pages(pages, len(tree)))
+
+
+def _geometries(pages, pageNums):
+    "Return page geometries for some page numbers of a _PageTree."
+
+    return [pages.geometry(num) for num in pageNums]
+
+
+def _streamGeometries(pages, pageNums, chunkSize=1024):
+    """Return page geometries for some page numbers of an _InputPages.
+
+    The objects parsed for every chunk of pages are dropped again, so
+    this needs little memory for any number of pages.
+    """
+
+    geometries = []
+    for i in range(0, len(pageNums), chunkSize):
+        geometries += _geometries(pages, pageNums[i:i + chunkSize])
+        pages.clearCaches()
+
+    return geometries
+
+
+def _composeSheets(pages, pageNums, plan, pool, firstSheet=0,
+                   lastSheet=None):
+    """Yield a new sheet for a range of sheets of some plan.
+
+    pages is a _PageTree of the source document and pageNums are the
+    numbers of the selected source pages the plan is made for. The
+    Form XObjects and contents of the sheets are added to the output
+    document of the resource pool, but the sheets themselves are not.
+    """
+
+    output = pool.pdf
+    forms = {}
+    for sheet, tiles in plan.sheetTiles(firstSheet, lastSheet):
+        tileList = []
+        sheetForms = {}
+        for i in tiles:
+            planPageNum, destPageNum, destRect, arr = plan.tile(i)
+            srcPageNum = pageNums[planPageNum]
+
+            # place the source page as a Form XObject, so its content
+            # is never parsed, and draw a page shown several times on
+            # a sheet, or also on the previous one, with the same one
+            formName = _name("/Fx%d" % srcPageNum)
+            form = sheetForms.get(srcPageNum, forms.get(srcPageNum))
+            if form is None:
+                page2 = pages[srcPageNum]
+                form = output._add_object(_pageAsFormXObject(page2, pool))
+            sheetForms[srcPageNum] = form
+            tileList.append((formName, form, arr))
+        forms = sheetForms
+
+        yield _composeSheet(plan.sheetSize, tileList, output,
+                            pool.profile["level"], pool.profile["precision"])
+
+
+class _PdfStreamWriter:
+    """Write a PDF document incrementally to some output stream.
+
+    Unlike PdfWriter, which keeps the whole document in memory until
+    it is written, every object is serialized as soon as it is added,
+    and source objects are copied (by a _ResourcePool) the first time
+    they are referenced. Only the byte offsets of written objects are
+    kept, so memory use does not grow with the number of pages.
+
+    Objects copied from the source document keep their object numbers,
+    so firstNum must be larger than all of them. The page tree and the
+    catalog get the numbers firstNum and firstNum + 1, and other new
+    objects are numbered consecutively from nextNum on. This way
+    several writers can write parts of the same document independently
+    (see _composeChunk), and the parts can be joined without writing
+    shared source objects twice.
+
+    If objStmNum is given, objects other than streams are packed into
+    object streams, compressed at some zlib level and numbered from
+    objStmNum on, and a cross-reference stream is written instead of a
+    table. If objectStreams is True instead, the object streams are
+    numbered like other new objects.
+
+    Sheets can also be added from a _SheetEntry, and all their objects
+    are then numbered like new ones (see addSheetEntry).
+    """
+
+    # number of objects packed into one object stream
+    objStmSize = 100
+
+    def __init__(self, stream, firstNum, nextNum=None, objStmNum=None,
+                 level=None, objectStreams=False):
+        _importPypdf()
+        self.stream = stream
+        self.offsets = {}
+        self.pos = 0
+        self.kids = []
+        self.pagesRef = IndirectObject(firstNum, 0, self)
+        self.rootRef = IndirectObject(firstNum + 1, 0, self)
+        self.nextNum = firstNum + 2 if nextNum is None else nextNum
+        self.objStmNum = objStmNum
+        self.pack = objectStreams or objStmNum is not None
+        self.level = 6 if level is None else level
+        self.packed = []
+        self.shared = {}
+        self._write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+    def _write(self, data):
+        self.stream.write(data)
+        self.pos += len(data)
+
+    def _reserve(self):
+        "Reserve the number for a new object written later."
+
+        ref = IndirectObject(self.nextNum, 0, self)
+        self.nextNum += 1
+
+        return ref
+
+    def _writeObject(self, ref, obj):
+        buf = io.BytesIO()
+        buf.write(b"%d 0 obj\n" % ref.idnum)
+        obj.write_to_stream(buf, None)
+        buf.write(b"\nendobj\n")
+        self.copyObject(ref.idnum, buf.getvalue())
+
+    def copyObject(self, num, data):
+        "Write an already serialized object with some number."
+
+        if not self.pack or data.endswith(b"endstream\nendobj\n"):
+            self.offsets[num] = self.pos
+            self._write(data)
+            return
+
+        # the offset is known when the object stream is written
+        self.offsets[num] = None
+        start = len(b"%d 0 obj\n" % num)
+        self.packed.append((num, data[start:-len(b"\nendobj\n")]))
+        if len(self.packed) >= self.objStmSize:
+            self._writeObjectStream()
+
+    def copySpans(self, file, spans):
+        """Copy objects written to a file by another _PdfStreamWriter.
+
+        spans are (number, offset, length) tuples of the objects, and
+        those written already are skipped. Runs of adjacent objects are
+        copied by the kernel, if possible, unless they are to be packed.
+        """
+
+        runs = []
+        for num, pos, length in spans:
+            if num in self.offsets:
+                continue
+            if runs and runs[-1][1] + runs[-1][2] == pos:
+                nums, start, size = runs[-1]
+                runs[-1] = nums + [(num, pos - start)], start, size + length
+            else:
+                runs.append(([(num, 0)], pos, length))
+            self.offsets[num] = None
+
+        for nums, start, size in runs:
+            if not self.pack and _sendfile(self.stream, file, start, size):
+                for num, pos in nums:
+                    self.offsets[num] = self.pos + pos
+                self.pos += size
+                continue
+            file.seek(start)
+            data = file.read(size)
+            ends = [pos for num, pos in nums[1:]] + [size]
+            for (num, pos), end in zip(nums, ends):
+                self.copyObject(num, data[pos:end])
+
+    def _writeObjectStream(self):
+        "Write the objects waiting to be packed as an object stream."
+
+        header, body = [], []
+        pos = 0
+        for num, data in self.packed:
+            header.append(b"%d %d" % (num, pos))
+            body.append(data)
+            pos += len(data) + 1
+        header = b" ".join(header) + b"\n"
+        objStm = _streamObject(header + b"\n".join(body), self.level)
+        objStm[NameObject("/Type")] = NameObject("/ObjStm")
+        objStm[NameObject("/N")] = NumberObject(len(self.packed))
+        objStm[NameObject("/First")] = NumberObject(len(header))
+
+        if self.objStmNum is None:
+            ref = self._reserve()
+        else:
+            ref = IndirectObject(self.objStmNum, 0, self)
+            self.objStmNum += 1
+        self.offsets[ref.idnum] = self.pos
+        buf = io.BytesIO()
+        buf.write(b"%d 0 obj\n" % ref.idnum)
+        objStm.write_to_stream(buf, None)
+        buf.write(b"\nendobj\n")
+        self._write(buf.getvalue())
+        for i, (num, data) in enumerate(self.packed):
+            self.offsets[num] = (ref.idnum, i)
+        self.packed = []
+
+    def _add_object(self, obj):
+        "Write a new object and return a reference to it."
+
+        ref = self._reserve()
+        self._writeObject(ref, obj)
+
+        return ref
+
+    def add_page(self, page):
+        "Write a page as the next one of the document."
+
+        page[_name("/Parent")] = self.pagesRef
+        self.kids.append(self._add_object(page))
+
+    def addSheetEntry(self, entry):
+        """Write the sheet of a _SheetEntry as the next page.
+
+        Objects of the entry are written unless an identical one was
+        written for an earlier entry already, as known by its digest.
+        """
+
+        nums = [self.pagesRef.idnum]
+        new = []
+        for num, digest in enumerate(entry.digests, 1):
+            outNum = self.shared.get(digest)
+            if outNum is None:
+                outNum = self.shared[digest] = self._reserve().idnum
+                new.append(num)
+            nums.append(outNum)
+        # the sheet itself is never shared
+        nums.append(self._reserve().idnum)
+        new.append(len(entry.items))
+
+        for num in new:
+            data, refs = entry.items[num - 1]
+            parts = [b"%d 0 obj\n" % nums[num]]
+            start = 0
+            for pos, ref in refs:
+                parts.append(data[start:pos])
+                parts.append(b"%d 0 R" % nums[ref])
+                start = pos + len(b"%d 0 R" % ref)
+            parts.append(data[start:])
+            parts.append(b"\nendobj\n")
+            self.copyObject(nums[num], b"".join(parts))
+        self.kids.append(IndirectObject(nums[-1], 0, self))
+
+    def close(self):
+        "Write the page tree, catalog, cross-reference table and trailer."
+
+        pages = DictionaryObject()
+        pages[NameObject("/Type")] = NameObject("/Pages")
+        pages[NameObject("/Kids")] = ArrayObject(self.kids)
+        pages[NameObject("/Count")] = NumberObject(len(self.kids))
+        self._writeObject(self.pagesRef, pages)
+        catalog = DictionaryObject()
+        catalog[NameObject("/Type")] = NameObject("/Catalog")
+        catalog[NameObject("/Pages")] = self.pagesRef
+        self._writeObject(self.rootRef, catalog)
+
+        if self.pack:
+            self._writeXrefStream()
+            return
+
+        # object numbers not used in the output are listed as free
+        size = max(self.offsets) + 1
+        xrefPos = self.pos
+        lines = [b"xref\n0 %d\n" % size]
+        for num in range(size):
+            pos = self.offsets.get(num)
+            if pos is None:
+                lines.append(b"0000000000 65535 f \n")
+            else:
+                lines.append(b"%010d 00000 n \n" % pos)
+        self._write(b"".join(lines))
+
+        trailer = DictionaryObject()
+        trailer[NameObject("/Size")] = NumberObject(size)
+        trailer[NameObject("/Root")] = self.rootRef
+        buf = io.BytesIO()
+        buf.write(b"trailer\n")
+        trailer.write_to_stream(buf, None)
+        buf.write(b"\nstartxref\n%d\n%%%%EOF\n" % xrefPos)
+        self._write(buf.getvalue())
+
+    def _writeXrefStream(self):
+        "Write remaining packed objects and a cross-reference stream."
+
+        if self.packed:
+            self._writeObjectStream()
+        if self.objStmNum is None:
+            xrefNum = self._reserve().idnum
+        else:
+            xrefNum = self.objStmNum
+        size = max(max(self.offsets), xrefNum) + 1
+        xrefPos = self.pos
+        self.offsets[xrefNum] = xrefPos
+        width = max(4, (xrefPos.bit_length() + 7) // 8)
+        rows = []
+        for num in range(size):
+            pos = self.offsets.get(num)
+            if pos is None:
+                # a free object number
+                rows.append(b"\x00" + bytes(width) + b"\xff\xff")
+            elif isinstance(pos, tuple):
+                rows.append(b"\x02" + pos[0].to_bytes(width, "big")
+                            + pos[1].to_bytes(2, "big"))
+            else:
+                rows.append(b"\x01" + pos.to_bytes(width, "big")
+                            + b"\x00\x00")
+        xref = _streamObject(b"".join(rows), self.level)
+        xref[NameObject("/Type")] = NameObject("/XRef")
+        xref[NameObject("/Size")] = NumberObject(size)
+        xref[NameObject("/W")] = ArrayObject(
+            NumberObject(w) for w in (1, width, 2))
+        xref[NameObject("/Root")] = self.rootRef
+
+        buf = io.BytesIO()
+        buf.write(b"%d 0 obj\n" % xrefNum)
+        xref.write_to_stream(buf, None)
+        buf.write(b"\nendobj\nstartxref\n%d\n%%%%EOF\n" % xrefPos)
+        self._write(buf.getvalue())
+
+
+class _ResourcePool:
+    """Copy source objects into an output document, each distinct one once.
+
+    Objects are copied bottom-up, and every copy is identified by a hash
+    of its serialized form, in which references to other objects point
+    to their already copied, distinct versions. So identical fonts,
+    images, ICC profiles, patterns etc. end up as a single shared object
+    in the output, even if the source contains them many times as
+    separate objects.
+
+    The output document is either a PdfWriter or a _PdfStreamWriter.
+    The output profile (see OUTPUT_PROFILES) decides if uncompressed
+    streams are compressed while copying.
+
+    Source documents are told apart by the id() of their reader, unless
+    sources maps it to a key and an offset added to the object numbers
+    kept by a _PdfStreamWriter, as for several inputs (see _InputPages).
+    """
+
+    def __init__(self, pdf, profile=None, sources=None):
+        import hashlib
+
+        _importPypdf()
+        self.sha256 = hashlib.sha256
+        self.pdf = pdf
+        self.sources = {} if sources is None else sources
+        self.profile = profile or OUTPUT_PROFILES["fast"]
+        if self.profile["recompress"]:
+            self.recompress = self.profile["level"]
+        else:
+            self.recompress = None
+        self.refs = {}
+        self.hashes = {}
+        self.copying = set()
+
+    def importObject(self, obj):
+        "Return a copy of a source object for the output document."
+
+        if isinstance(obj, IndirectObject):
+            return self._importIndirect(obj)
+        elif isinstance(obj, StreamObject):
+            if "/Filter" in obj:
+                copy = EncodedStreamObject()
+                copy._data = obj._data
+            else:
+                copy = _streamObject(obj._data, self.recompress)
+        elif isinstance(obj, DictionaryObject):
+            copy = DictionaryObject()
+        elif isinstance(obj, ArrayObject):
+            return ArrayObject(self.importObject(x) for x in obj)
+        elif isinstance(obj, NameObject):
+            return _name(obj)
+        else:
+            return obj
+
+        for key, value in obj.items():
+            copy[_name(key)] = self.importObject(value)
+
+        return copy
+
+    def _importIndirect(self, ref):
+        if ref.pdf is self.pdf:
+            return ref
+        source, offset = self.sources.get(id(ref.pdf), (id(ref.pdf), 0))
+        key = source, ref.idnum
+        if key in self.refs:
+            return self.refs[key]
+        if key in self.copying:
+            # a reference cycle, so reserve the object to be filled later
+            self.refs[key] = self._reserve(ref.idnum + offset)
+            return self.refs[key]
+
+        self.copying.add(key)
+        copy = self.importObject(ref.get_object())
+        self.copying.discard(key)
+        buf = io.BytesIO()
+        copy.write_to_stream(buf, None)
+        data = buf.getvalue()
+
+        if key in self.refs:
+            # part of a cycle, so it can't be identified by its content
+            newRef = self.refs[key]
+            self._store(newRef, copy, data)
+            return newRef
+
+        digest = self.sha256(data).digest()
+        newRef = self.hashes.get(digest)
+        if newRef is None:
+            newRef = self.hashes[digest] = self._reserve(ref.idnum + offset)
+            self._store(newRef, copy, data)
+        self.refs[key] = newRef
+
+        return newRef
+
+    def _reserve(self, num):
+        "Reserve an object, numbered num when streaming."
+
+        if isinstance(self.pdf, _PdfStreamWriter):
+            return IndirectObject(num, 0, self.pdf)
+
+        return self.pdf._add_object(NullObject())
+
+    def _store(self, ref, copy, data):
+        if isinstance(self.pdf, _PdfStreamWriter):
+            obj = b"%d 0 obj\n%s\nendobj\n" % (ref.idnum, data)
+            self.pdf.copyObject(ref.idnum, obj)
+        else:
+            self.pdf._objects[ref.idnum - 1] = copy
+
+
+def _sourceSize(reader):
+    "Return a number larger than all object numbers of some document."
+
+    nums = [reader.trailer.get("/Size", 0)]
+    for gen, idnums in reader.xref.items():
+        nums.extend(num + 1 for num in idnums)
+    nums.extend(num + 1 for num in reader.xref_objStm)
+
+    return max(nums)
+
+
+def _composeChunk(job):
+    """Compose a range of sheets into a temporary file (in some process).
+
+    Return the path of the temporary file, a list of (objectNum, offset,
+    length) tuples for the objects written to it, and the object numbers
+    of the sheets.
+    """
+
+    import tempfile
+
+    inPath, plan, pageNums, firstSheet, lastSheet, profile, mapFile = job
+    _importPypdf()
+
+    with _openInput(inPath, mapFile=mapFile) as stream, \
+            tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+        try:
+            reader = PdfReader(stream)
+            # every sheet has at most n Form XObjects, a content stream
+            # and itself
+            firstNum = _sourceSize(reader)
+            nextNum = firstNum + 2 + firstSheet * (plan.n + 2)
+            # objects are packed in object streams when joining the parts
+            output = _PdfStreamWriter(f, firstNum, nextNum)
+            pool = _ResourcePool(output, profile)
+            sheets = _composeSheets(_PageTree(reader), pageNums, plan, pool,
+                                    firstSheet, lastSheet)
+            for sheet in sheets:
+                output.add_page(sheet)
+                reader.resolved_objects.clear()
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+
+    ends = list(output.offsets.values())[1:] + [output.pos]
+    spans = [
+        (num, pos, end - pos)
+        for (num, pos), end in zip(output.offsets.items(), ends)]
+
+    return f.name, spans, [ref.idnum for ref in output.kids]
+
+
+def _firstObjStmNum(firstNum, plan):
+    """Return the first number for object streams of a streamed document.
+
+    It is larger than those of all sheets, which are numbered in blocks,
+    see _composeChunk.
+    """
+
+    return firstNum + 2 + plan.numSheets * (plan.n + 2)
+
+
+def _streamWriter(stream, firstNum, plan, profile, renumber=False):
+    """Return a _PdfStreamWriter for composing a plan.
+
+    firstNum is larger than the numbers of all source objects (see
+    _sourceSize). If renumber is True, no source object numbers are
+    kept, as needed for adding sheets from a SheetCache.
+    """
+
+    if renumber:
+        return _PdfStreamWriter(stream, 1, level=profile["level"],
+                                objectStreams=profile["objectStreams"])
+
+    if profile["objectStreams"]:
+        objStmNum = _firstObjStmNum(firstNum, plan)
+    else:
+        objStmNum = None
+
+    return _PdfStreamWriter(
+        stream, firstNum, objStmNum=objStmNum, level=profile["level"])
+
+
+@contextlib.contextmanager
+def _openOutput(outFile):
+    """Return a stream to write some output to.
+
+    Paths are opened here, closed when done and removed again if an
+    error occurs, so no partial output is left behind. File-like
+    objects are used as they are.
+    """
+
+    if isinstance(outFile, io.IOBase):
+        yield outFile
+        return
+
+    try:
+        with outFile.open('wb') as outStream:
+            yield outStream
+    except BaseException:
+        outFile.unlink(missing_ok=True)
+        raise
+
+
+def _removeChunks(futures):
+    "Remove the files of chunks not joined, once their jobs are done."
+
+    import concurrent.futures
+
+    for future in futures:
+        future.cancel()
+    concurrent.futures.wait(futures)
+    for future in futures:
+        if not future.cancelled() and future.exception() is None:
+            os.remove(future.result()[0])
+
+
+def _writeParallel(reader, inFile, plan, pageNums, outFile, processes,
+                   profile, mapFile=False):
+    "Compose sheets in several processes and join them into outFile."
+
+    import concurrent.futures
+    import shutil
+    import tempfile
+
+    if not isinstance(inFile, pathlib.Path):
+        # the workers need a file they can open on their own
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+            reader.stream.seek(0)
+            shutil.copyfileobj(reader.stream, f)
+        inPath = tmpPath = f.name
+    else:
+        inPath, tmpPath = str(inFile), None
+
+    numSheets = plan.numSheets
+    chunkSize = math.ceil(numSheets / processes)
+    jobs = [
+        (inPath, plan, pageNums, first, min(first + chunkSize, numSheets),
+         profile, mapFile)
+        for first in range(0, numSheets, chunkSize)]
+
+    try:
+        with _openOutput(outFile) as outStream:
+            output = _streamWriter(outStream, _sourceSize(reader), plan,
+                                   profile)
+            with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+                futures = [pool.submit(_composeChunk, job) for job in jobs]
+                joined = 0
+                try:
+                    for future in futures:
+                        path, spans, kids = future.result()
+                        with open(path, 'rb') as f:
+                            # source objects shared by several chunks
+                            # are only written once
+                            output.copySpans(f, spans)
+                        os.remove(path)
+                        joined += 1
+                        output.kids.extend(
+                            IndirectObject(k, 0, output) for k in kids)
+                finally:
+                    _removeChunks(futures[joined:])
+            output.close()
+    finally:
+        if tmpPath is not None:
+            os.remove(tmpPath)
+
+
+class _SourceDigests:
+    """Content digests of source pages, as used for SheetCache keys.
+
+    The digest of a page covers all _pageAsFormXObject() uses of it,
+    including the objects its contents and resources refer to, directly
+    or not, but not their object numbers. Digests of indirect objects
+    are kept, so objects shared by many pages are hashed only once.
+
+    Objects without any references, like most images, fonts files and
+    content streams, are hashed as they are in the file, without being
+    parsed. Source documents are told apart as by a _ResourcePool with
+    the same sources.
+    """
+
+    objHeader = re.compile(rb"\s*\d+\s+\d+\s+obj")
+    streamStart = re.compile(rb">>\s*stream\r?\n")
+    streamEnd = re.compile(rb"\s*endstream")
+    lengthPattern = re.compile(rb"/Length\s+(\d+)")
+    refPattern = re.compile(rb"\d+\s+\d+\s+R")
+
+    def __init__(self, sources=None):
+        import hashlib
+
+        self.sha256 = hashlib.sha256
+        self.sources = {} if sources is None else sources
+        self.digests = {}
+        self.visiting = set()
+        self.cycles = 0
+        self.starts = {}
+
+    def page(self, page):
+        "Return the digest of a source page."
+
+        h = self.sha256()
+        for key in ("/Contents", "/MediaBox", "/Resources"):
+            self._update(h, page.raw_get(key) if key in page else None)
+
+        return h.digest()
+
+    def digest(self, ref):
+        "Return the digest of an indirect object and all it refers to."
+
+        source = self.sources.get(id(ref.pdf), (id(ref.pdf), 0))[0]
+        key = source, ref.idnum, ref.generation
+        digest = self.digests.get(key)
+        if digest is not None:
+            return digest
+        if key in self.visiting:
+            # a reference cycle, covered by the object it starts at
+            self.cycles += 1
+            return bytes(32)
+
+        data = self._rawObject(ref.pdf, key)
+        if data is not None:
+            digest = self.digests[key] = self.sha256(data).digest()
+            return digest
+
+        self.visiting.add(key)
+        cycles = self.cycles
+        h = self.sha256(b"obj")
+        self._update(h, ref.get_object())
+        digest = h.digest()
+        self.visiting.discard(key)
+        if cycles == self.cycles:
+            # keep only digests not depending on where hashing started
+            self.digests[key] = digest
+
+        return digest
+
+    def _rawObject(self, reader, key):
+        """Return the code of an object in the file, if it has no references.
+
+        Return None for objects in object streams, with references or
+        that could not be found.
+        """
+
+        source, num, gen = key
+        start = reader.xref.get(gen, {}).get(num)
+        if start is None:
+            return None
+        starts = self.starts.get(source)
+        if starts is None:
+            # objects end where the next one starts, or the file ends
+            starts = self.starts[source] = sorted(
+                pos for nums in reader.xref.values() for pos in nums.values())
+            starts.append(_streamSize(reader.stream))
+        i = bisect.bisect_right(starts, start)
+        if i == len(starts):
+            return None
+        stream = reader.stream
+        stream.seek(start)
+        data = stream.read(starts[i] - start)
+        header = self.objHeader.match(data)
+        if header is None:
+            return None
+
+        # without strings and comments, the first "stream" keyword after
+        # a dictionary ends it, and references can only be in front
+        match = self.streamStart.search(data, header.end())
+        if match is None:
+            end = data.find(b"endobj", header.end())
+            if end < 0:
+                return None
+            head = data[header.end():end]
+        else:
+            head = data[header.end():match.start()]
+            length = self.lengthPattern.search(head)
+            if length is None:
+                return None
+            end = match.end() + int(length[1])
+            if not self.streamEnd.match(data, end):
+                return None
+        if b"(" in head or b"%" in head or self.refPattern.search(head):
+            return None
+
+        return data[header.end():end]
+
+    def _update(self, h, obj):
+        "Add a direct object to a hash, with digests of those it refers to."
+
+        if isinstance(obj, IndirectObject):
+            h.update(b"R")
+            h.update(self.digest(obj))
+        elif isinstance(obj, DictionaryObject):
+            h.update(b"<<%d " % len(obj))
+            for key, value in obj.items():
+                self._update(h, key)
+                self._update(h, value)
+            if isinstance(obj, StreamObject):
+                h.update(b"stream %d " % len(obj._data))
+                h.update(obj._data)
+        elif isinstance(obj, ArrayObject):
+            h.update(b"[%d " % len(obj))
+            for value in obj:
+                self._update(h, value)
+        else:
+            # the type and value of a number, name, string etc.
+            text = repr(obj).encode("utf-8", "surrogatepass")
+            h.update(b"%s %d " % (type(obj).__name__.encode(), len(text)))
+            h.update(text)
+
+
+def _sheetKey(digests, plan, tiles, pages, pageNums, profile):
+    """Return the SheetCache key of a sheet of some plan.
+
+    It is a hash of everything the composed sheet depends on: the
+    versions of pdfnup and pypdf, the layout and profile settings and,
+    for every tile, its matrix and source page.
+    """
+
+    _importPypdf()
+    h = digests.sha256(f"pdfnup {__version__} pypdf {_pypdfVersion}"
+                       .encode())
+    settings = (plan.sheetSize, profile["level"], profile["recompress"],
+                profile["precision"])
+    h.update(repr(settings).encode())
+    for i in tiles:
+        planPageNum, sheet, rect, matrix = plan.tile(i)
+        srcPageNum = pageNums[planPageNum]
+        # the page number is part of the Form XObject's name
+        h.update(repr((srcPageNum, matrix)).encode())
+        h.update(digests.page(pages[srcPageNum]))
+
+    return h.hexdigest()
+
+
+class _SheetBuilder:
+    """Collect a sheet and all objects it needs into a _SheetEntry.
+
+    This stands in for the output document of a _ResourcePool, which
+    copies objects into it as into a PdfWriter, so a sheet can be
+    composed on its own, independently of any output document.
+    """
+
+    def __init__(self):
+        self._objects = []
+        self.positions = []
+
+    def _add_object(self, obj):
+        self._objects.append(obj)
+
+        return _EntryRef(len(self._objects), 0, self)
+
+    def entry(self, sheet, key):
+        "Return a _SheetEntry with a sheet composed from this builder."
+
+        sheet[NameObject("/Parent")] = _EntryRef(0, 0, self)
+        items = []
+        for obj in self._objects + [sheet]:
+            self.positions = []
+            buf = io.BytesIO()
+            obj.write_to_stream(buf, None)
+            items.append((buf.getvalue(), self.positions))
+
+        return _SheetEntry(items, key)
+
+
+class _SheetEntry:
+    """A sheet and all objects it needs, serialized for a SheetCache.
+
+    items are (data, refs) tuples of the objects, numbered from 1 on
+    and with the sheet last, and refs are the (position, number) pairs
+    of the references in their data, with number 0 for the page tree.
+    Every object but the sheet gets a digest covering its data and
+    those of the objects it refers to, so identical objects of several
+    sheets can be written only once (see _PdfStreamWriter).
+    """
+
+    def __init__(self, items, key, cached=False):
+        import hashlib
+
+        self.items = items
+        self.cached = cached
+        self.digests = []
+        for num, (data, refs) in enumerate(items[:-1], 1):
+            h = hashlib.sha256()
+            start = 0
+            for pos, ref in refs:
+                if not 0 < ref < num:
+                    # part of a reference cycle, so never shared
+                    h = hashlib.sha256(b"%s %d" % (key.encode(), num))
+                    break
+                h.update(data[start:pos])
+                h.update(self.digests[ref - 1])
+                start = pos + len(b"%d 0 R" % ref)
+            else:
+                h.update(data[start:])
+            self.digests.append(h.digest())
+
+    def toBytes(self):
+        "Return the entry serialized."
+
+        import json
+
+        header = json.dumps([[len(data), refs] for data, refs in self.items])
+
+        return header.encode() + b"\n" + b"".join(
+            data for data, refs in self.items)
+
+    @classmethod
+    def fromBytes(cls, data, key):
+        "Return an entry from its serialized form, raising ValueError."
+
+        import json
+
+        end = data.index(b"\n")
+        items = []
+        pos = end + 1
+        for size, refs in json.loads(data[:end]):
+            items.append((data[pos:pos+size], refs))
+            pos += size
+        if pos != len(data) or not items:
+            raise ValueError("Damaged sheet cache entry!")
+
+        return cls(items, key, cached=True)
+
+
+class SheetCache:
+    """An on-disk cache of composed sheets, see generateNup().
+
+    Sheets are stored as files in some directory, named after a hash of
+    the layout, the output profile and the contents of their source
+    pages (but not their object numbers). After editing a few pages of
+    a document, only the sheets showing them are composed again, and
+    all others are copied from the cache. When the files take more than
+    max_size bytes, the least recently used ones are removed. Several
+    documents can share a cache.
+    """
+
+    suffix = ".sheet"
+
+    def __init__(self, directory, max_size=1 << 30):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+        # the least recently used files first
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.suffix) and entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        files.sort()
+        self.sizes = collections.OrderedDict(
+            (name, size) for mtime, name, size in files)
+        self.size = sum(self.sizes.values())
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def get(self, key):
+        "Return the data stored for some key, or None."
+
+        name = key + self.suffix
+        path = self.directory / name
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+                self.size -= self.sizes.pop(name, 0)
+            return None
+
+        with self.lock:
+            self.hits += 1
+            self.size += len(data) - self.sizes.pop(name, 0)
+            self.sizes[name] = len(data)
+
+        return data
+
+    def put(self, key, data):
+        "Store data for some key, removing least recently used data."
+
+        import tempfile
+
+        name = key + self.suffix
+        with tempfile.NamedTemporaryFile(
+                dir=self.directory, suffix=".tmp", delete=False) as f:
+            f.write(data)
+        os.replace(f.name, self.directory / name)
+
+        with self.lock:
+            self.size += len(data) - self.sizes.pop(name, 0)
+            self.sizes[name] = len(data)
+            while self.size > self.max_size:
+                old, size = self.sizes.popitem(last=False)
+                self.size -= size
+                try:
+                    os.remove(self.directory / old)
+                except FileNotFoundError:
+                    pass
+
+
+def _cachedSheets(pages, pageNums, plan, profile, cache):
+    """Yield a _SheetEntry for every sheet of a plan, using a SheetCache.
+
+    Sheets found in the cache are read from it, others are composed,
+    each on its own, and stored in it.
+    """
+
+    digests = _SourceDigests(pages.sources)
+    for sheet, tiles in plan.sheetTiles():
+        key = _sheetKey(digests, plan, tiles, pages, pageNums, profile)
+        data = cache.get(key)
+        entry = None
+        if data is not None:
+            try:
+                entry = _SheetEntry.fromBytes(data, key)
+            except (ValueError, TypeError):
+                # a damaged entry, to be replaced
+                pass
+        if entry is None:
+            builder = _SheetBuilder()
+            pool = _ResourcePool(builder, profile, pages.sources)
+            page, = _composeSheets(
+                pages, pageNums, plan, pool, sheet, sheet + 1)
+            entry = builder.entry(page, key)
+            cache.put(key, entry.toBytes())
+        yield entry
+
+
+def _spoolInput(inFile, maxMemory=None):
+    """Return a seekable version of some file-like input.
+
+    Non-seekable input (like a pipe) is copied into a temporary file,
+    which stays in memory up to maxMemory bytes and spills to disk
+    beyond that.
+    """
+
+    if inFile.seekable():
+        return inFile
+
+    import shutil
+    import tempfile
+
+    spool = tempfile.SpooledTemporaryFile(max_size=maxMemory or 0)
+    shutil.copyfileobj(inFile, spool)
+    spool.seek(0)
+
+    return spool
+
+
+@contextlib.contextmanager
+def _openInput(inFile, maxMemory=None, mapFile=False):
+    """Return a seekable stream to read some PDF input from, only once.
+
+    Paths are opened for buffered reading, or if mapFile is set,
+    memory-mapped, so the operating system pages the file in as needed
+    instead of it being read and copied into memory. A mapping is only
+    safe for files nothing else writes to, as truncating a mapped file
+    kills the process with SIGBUS. bytes
+    (and memoryviews of them) are used without copying. Other buffers
+    like bytearray are copied once, as they may change while being
+    read. File-like objects are spooled as needed (see _spoolInput).
+    """
+
+    if isinstance(inFile, (str, pathlib.Path)):
+        with open(inFile, 'rb') as file:
+            if not mapFile:
+                yield file
+                return
+            try:
+                stream = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # empty files and special files can't be mapped
+                stream = None
+            if stream is None:
+                yield file
+                return
+        try:
+            yield stream
+        finally:
+            stream.close()
+    elif isinstance(inFile, (bytes, bytearray, memoryview)):
+        view = memoryview(inFile)
+        if isinstance(view.obj, bytes) and view.nbytes == len(view.obj):
+            yield io.BytesIO(view.obj)
+        else:
+            yield io.BytesIO(view)
+    else:
+        yield _spoolInput(inFile, maxMemory)
+
+
+def _sendfile(out, file, offset, count):
+    """Copy count bytes of a file at some offset to out by the kernel.
+
+    out is a binary file or stream, which is flushed first. Return
+    False, with nothing copied, if either has no file descriptor or
+    the system cannot copy between them.
+    """
+
+    if not hasattr(os, "sendfile"):
+        return False
+    try:
+        outFd, inFd = out.fileno(), file.fileno()
+    except (AttributeError, OSError, ValueError):
+        return False
+
+    out.flush()
+    file.flush()
+    pos, end = offset, offset + count
+    try:
+        while pos < end:
+            sent = os.sendfile(outFd, inFd, pos, end - pos)
+            if not sent:
+                raise EOFError("File is shorter than expected!")
+            pos += sent
+    except OSError:
+        if pos > offset:
+            raise
+        return False
+    if out.seekable():
+        # the position of the file descriptor moved behind out's back
+        out.seek(0, os.SEEK_CUR)
+
+    return True
+
+
+class OutputSpool(io.RawIOBase):
+    """A binary buffer for output, spilling to a file beyond max_memory.
+
+    Up to max_memory bytes (16 MiB by default) are kept in memory, and
+    beyond that all data is moved to a temporary file in directory dir,
+    which is removed when the spool is closed. Unlike with a
+    SpooledTemporaryFile, the file has a name, so it can be handed over
+    to another process, and sendfile() copies it to a file or socket
+    without passing the data through Python.
+    """
+
+    # default of max_memory
+    maxMemory = 1 << 24
+
+    def __init__(self, max_memory=None, dir=None):
+        super().__init__()
+        if max_memory is not None:
+            self.maxMemory = max_memory
+        self.dir = dir
+        self.file = io.BytesIO()
+        self.name = None
+
+    @classmethod
+    def _adopt(cls, data):
+        "Return a spool with the data release() returned in some process."
+
+        spool = cls()
+        if isinstance(data, str):
+            spool.file, spool.name = open(data, "r+b"), data
+        else:
+            spool.file = io.BytesIO(data)
+
+        return spool
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def fileno(self):
+        if self.name is None:
+            raise io.UnsupportedOperation("Output spool is in memory!")
+
+        return self.file.fileno()
+
+    @property
+    def size(self):
+        "The number of bytes in the spool."
+
+        if self.name is None:
+            return self.file.getbuffer().nbytes
+
+        self.file.flush()
+
+        return os.fstat(self.file.fileno()).st_size
+
+    def _rollover(self):
+        "Move the data from memory to a temporary file."
+
+        import tempfile
+
+        fd, name = tempfile.mkstemp(suffix=".pdf", dir=self.dir)
+        file = open(fd, "w+b")
+        file.write(self.file.getbuffer())
+        file.seek(self.file.tell())
+        self.file, self.name = file, name
+
+    def write(self, data):
+        if self.name is None and (
+                self.file.tell() + len(data) > self.maxMemory):
+            self._rollover()
+
+        return self.file.write(data)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def readinto(self, buffer):
+        return self.file.readinto(buffer)
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        return self.file.seek(pos, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def truncate(self, size=None):
+        return self.file.truncate(size)
+
+    def flush(self):
+        if not self.file.closed:
+            self.file.flush()
+
+    def getvalue(self):
+        "Return all data as bytes."
+
+        if self.name is None:
+            return self.file.getvalue()
+
+        self.file.flush()
+        with open(self.name, "rb") as file:
+            return file.read()
+
+    def sendfile(self, out):
+        """Write all data to out, a binary file or stream.
+
+        If the data has spilled to disk and out has a file descriptor,
+        like a file or socket, the data is copied by the kernel.
+        """
+
+        if self.name is not None and _sendfile(out, self.file, 0, self.size):
+            return
+
+        if self.name is None:
+            out.write(self.file.getbuffer())
+        else:
+            import shutil
+
+            pos = self.file.tell()
+            self.file.seek(0)
+            shutil.copyfileobj(self.file, out)
+            self.file.seek(pos)
+        out.flush()
+
+    def release(self):
+        """Close the spool and return its data, to pass to another process.
+
+        This is the data as bytes, if it is in memory, else the path of
+        the file it spilled to, which is then no longer removed, see
+        _adopt().
+        """
+
+        if self.name is None:
+            data = self.file.getvalue()
+        else:
+            data, self.name = self.name, None
+        self.close()
+
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.file.close()
+            if self.name is not None:
+                os.remove(self.name)
+        finally:
+            super().close()
+
+
+class _InputPages:
+    """Random access to the pages of one or more inputs, one after another.
+
+    Every input is opened (see _openInput, mapping paths if mapFiles is
+    set) when its pages are needed, and at most maxOpen inputs are kept
+    open at a time, closing the least recently used one beyond that.
+    Non-seekable streams are spooled once, when first opened, so they
+    can be opened again.
+
+    sources maps the id() of the reader of every open input to its
+    index and the offset added to its object numbers when they are kept
+    in the output, for a _ResourcePool and _SourceDigests. firstNum is
+    larger than all of these numbers (see _sourceSize).
+    """
+
+    def __init__(self, inputs, maxOpen=8, maxMemory=None, mapFiles=False):
+        _importPypdf()
+        self.inputs = [
+            pathlib.Path(inFile) if isinstance(inFile, str) else inFile
+            for inFile in inputs]
+        self.maxOpen = max(1, maxOpen)
+        self.maxMemory = maxMemory
+        self.mapFiles = mapFiles
+        self.open = collections.OrderedDict()
+        self.sources = {}
+        self.spools = contextlib.ExitStack()
+        self.starts = []
+        self.offsets = []
+        self.bytes = 0
+        self.numPages = 0
+        self.firstNum = 0
+        try:
+            for i in range(len(self.inputs)):
+                self.starts.append(self.numPages)
+                self.offsets.append(0 if i == 0 else self.firstNum)
+                tree = self._tree(i)
+                self.bytes += _streamSize(tree.reader.stream)
+                self.numPages += len(tree)
+                self.firstNum += _sourceSize(tree.reader)
+        except BaseException:
+            self.close()
+            raise
+
+    def __len__(self):
+        return self.numPages
+
+    def __getitem__(self, num):
+        if not 0 <= num < self.numPages:
+            raise IndexError("Page index out of range!")
+        i = bisect.bisect_right(self.starts, num) - 1
+
+        return self._tree(i)[num - self.starts[i]]
+
+    def geometry(self, num):
+        "Return the (x0, y0, x1, y1, rotation) tuple of a page."
+
+        if not 0 <= num < self.numPages:
+            raise IndexError("Page index out of range!")
+        i = bisect.bisect_right(self.starts, num) - 1
+
+        return self._tree(i).geometry(num - self.starts[i])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.close()
+
+    def reader(self, i):
+        "Return the reader of an input."
+
+        return self._tree(i).reader
+
+    def _tree(self, i):
+        "Return the _PageTree of an input, opening it as needed."
+
+        entry = self.open.get(i)
+        if entry is not None:
+            self.open.move_to_end(i)
+            return entry[1]
+
+        while len(self.open) >= self.maxOpen:
+            self._close(next(iter(self.open)))
+        inFile = self.inputs[i]
+        if not isinstance(inFile, (pathlib.Path, bytes, bytearray,
+                                   memoryview)) and not inFile.seekable():
+            inFile = self.inputs[i] = self.spools.enter_context(
+                _spoolInput(inFile, self.maxMemory))
+        stack = contextlib.ExitStack()
+        try:
+            stream = stack.enter_context(
+                _openInput(inFile, self.maxMemory, self.mapFiles))
+            tree = _PageTree(PdfReader(stream))
+        except BaseException:
+            stack.close()
+            raise
+        self.open[i] = stack, tree
+        self.sources[id(tree.reader)] = i, self.offsets[i]
+
+        return tree
+
+    def _close(self, i):
+        stack, tree = self.open.pop(i)
+        del self.sources[id(tree.reader)]
+        stack.close()
+
+    def clearCaches(self):
+        "Drop the objects parsed so far by the readers of open inputs."
+
+        for stack, tree in self.open.values():
+            tree.reader.resolved_objects.clear()
+
+    def close(self):
+        "Close all inputs."
+
+        while self.open:
+            self._close(next(iter(self.open)))
+        self.spools.close()
+
+
+class _Phase:
+    "A context manager reporting the duration of a phase to on_event."
+
+    def __init__(self, on_event, name):
+        self.on_event = on_event
+        self.name = name
+        self.info = {}
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.info
+
+    def __exit__(self, excType, exc, tb):
+        if excType is not None:
+            self.info["error"] = excType.__name__
+        self.on_event(self.name, self.start, time.perf_counter(), self.info)
+
+
+class _NoPhase:
+    "A do-nothing stand-in for _Phase, used when tracing is disabled."
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, excType, exc, tb):
+        pass
+
+
+_noPhase = _NoPhase()
+
+
+def _phase(on_event, name):
+    "Return a context manager timing a phase, if on_event is set."
+
+    return _noPhase if on_event is None else _Phase(on_event, name)
+
+
+def _streamSize(stream):
+    "Return the size of a seekable stream."
+
+    pos = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(pos)
+
+    return size
+
+
+def _tell(stream):
+    "Return the position of a stream, or None if it is not seekable."
+
+    try:
+        return stream.tell()
+    except (OSError, AttributeError):
+        return None
+
+
+def _objectCount(output):
+    "Return the number of objects added to an output document so far."
+
+    if isinstance(output, _PdfStreamWriter):
+        return len(output.offsets)
+
+    return len(output._objects)
+
+
+class TraceCollector:
+    """Collect the events reported by generateNup for later analysis.
+
+    An instance can be passed as on_event to generateNup (and thus to
+    generateNupBatch with jobs=1 or generate_nup_async with threads).
+    Events are (name, start, end, info, threadId) tuples, with start
+    and end from time.perf_counter().
+    """
+
+    def __init__(self):
+        self.events = []
+        self.pid = os.getpid()
+
+    def __call__(self, name, start, end, info):
+        self.events.append((name, start, end, info, threading.get_ident()))
+
+    def to_json(self):
+        "Return all events as a list of JSON-compatible dicts."
+
+        return [
+            dict(info, name=name, start=start, duration=end - start)
+            for name, start, end, info, tid in self.events
+        ]
+
+    def write_json(self, path):
+        "Write all events to a JSON file."
+
+        import json
+
+        with open(path, "w") as file:
+            json.dump(self.to_json(), file, indent=1)
+
+    def to_chrome_trace(self):
+        "Return all events in the Chrome trace event format."
+
+        origin = min((e[1] for e in self.events), default=0)
+        traceEvents = [
+            {
+                "name": name,
+                "ph": "X",
+                "ts": (start - origin) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": self.pid,
+                "tid": tid,
+                "args": info,
+            }
+            for name, start, end, info, tid in self.events
+        ]
+
+        return {"traceEvents": traceEvents, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path):
+        "Write all events to a file for chrome://tracing or Perfetto."
+
+        import json
+
+        with open(path, "w") as file:
+            json.dump(self.to_chrome_trace(), file)
+
+
+def _defaultOutPath(inPath, n):
+    "Return the output path used for some input path if none is given."
+
+    inPath = pathlib.Path(inPath)
+    nDesc = "%dx%d" % n if isinstance(n, tuple) else n
+
+    return inPath.parent / f"{inPath.stem}-{nDesc}up{inPath.suffix}"
+
+
+def _repeatPages(pageNums, repeat):
+    "Return page numbers with every one repeated some number of times."
+
+    if not isinstance(repeat, int) or repeat < 1:
+        raise ValueError(f"Invalid number of repetitions: {repeat!r}")
+    if repeat == 1:
+        return pageNums
+
+    return [num for num in pageNums for i in range(repeat)]
+
+
+def _inputList(inPathOrFile):
+    "Return the list of inputs given as one input or a list of them."
+
+    if isinstance(inPathOrFile, (list, tuple)):
+        inputs = list(inPathOrFile)
+        if not inputs:
+            raise ValueError("No inputs given!")
+        return inputs
+
+    return [inPathOrFile]
+
+
+def _isInput(path, inputs):
+    "Is a path the same file as one of some inputs?"
+
+    for inFile in inputs:
+        if isinstance(inFile, (str, pathlib.Path)):
+            try:
+                if os.path.samefile(inFile, path):
+                    return True
+            except OSError:
+                pass
+
+    return False
+
+
+def generateNup(
+    inPathOrFile: io.IOBase | pathlib.Path | str | bytes | memoryview | list,
+    n: int | tuple[int, int],
+    outPathPatternOrFile: io.IOBase | pathlib.Path | str | None = None,
+    dirs="RD",
+    verbose: bool = False,
+    fit: bool = False,
+    streaming: bool = False,
+    max_memory: int | None = None,
+    processes: int = 1,
+    plan: "NupPlan | None" = None,
+    on_event=None,
+    pages=None,
+    profile: str = "fast",
+    precision: int | None = None,
+    cache: "SheetCache | pathlib.Path | str | None" = None,
+    max_open: int = 8,
+    repeat: int = 1,
+    mmap_input: bool = False,
+):
+    """Generate a N-up document version.
+
+    The input is a path, a binary file-like object or the PDF code
+    itself as bytes, bytearray or memoryview. If mmap_input is True,
+    paths are memory-mapped instead of being read through a buffer.
+    Only use this for files nothing else writes to while they are
+    read, as truncating a mapped file kills the process (SIGBUS). The
+    output must not be one of the input files.
+
+    The input can also be a list or tuple of such inputs, whose pages
+    follow each other on the sheets as if they were one document. They
+    are opened when their pages are needed, keeping at most max_open
+    of them open at a time, and resources they have in common, like
+    fonts and logos, are written only once.
+
+    If outPathPatternOrFile is None, the output will be written
+    in a file named after the input file.
+
+    n is a square or half square number, or a (rows, cols) tuple for
+    any other grid. Pages are stretched to fill their tiles, or, if fit
+    is True, scaled keeping their aspect ratio. Rotated pages are shown
+    as with their /Rotate value.
+
+    If streaming is True, finished sheets are written to the output
+    incrementally, and the state kept per sheet is freed as we go, so
+    memory use stays roughly constant for any number of pages. The
+    max_memory hint (in bytes) limits how much of a non-seekable input
+    stream is buffered in memory before spilling to a temporary file.
+
+    If processes is larger than 1, ranges of sheets are composed in
+    that many worker processes, each opening the input on its own, and
+    the parts are joined into one document. This implies streaming and
+    is done for a single input only.
+
+    pages selects the source pages to use, in the given order, as
+    described for select_pages(), e.g. "200-260" or range(199, 260),
+    numbering the pages of several inputs consecutively.
+    Only the page tree nodes and pages selected are ever resolved, so
+    the time needed depends on the selection, not the document size.
+
+    If repeat is larger than 1, every selected page is placed that many
+    times in a row, e.g. to fill sheets of labels with n=8, repeat=8.
+    All copies of a page on a sheet draw the same Form XObject, so the
+    output grows with the number of pages, not of copies. The number
+    of pages used is returned, not counting copies.
+
+    A plan made by plan_nup() for a document with the same page
+    geometries (including repeated ones) can be passed to skip planning
+    the layout again.
+
+    profile trades time for output size, see OUTPUT_PROFILES: "fast"
+    writes new content uncompressed and source streams as they are,
+    "balanced" compresses new content and rounds its numbers to 4
+    decimals, and "small" also compresses all uncompressed source
+    streams at the highest zlib level, rounds to 3 decimals and packs
+    objects into object streams (which implies streaming). precision
+    overrides the number of decimals. Page contents made of several
+    compressed streams are joined and always compressed again.
+
+    cache is a SheetCache, or the directory of one, to reuse sheets
+    composed before from the same source pages with the same layout
+    and profile, instead of composing them again. So after changing a
+    few pages, only the sheets showing them are rebuilt, but the source
+    pages are still read to find out which have changed. Using a cache
+    implies streaming in a single process.
+
+    If on_event is set, it is called as on_event(name, start, end, info)
+    after every phase, with perf_counter() timestamps and a dict of
+    phase specific details: "read" (bytes, objects, pages), "plan"
+    ("sheets"), "sheet" (index, objects and, when streaming, bytes for
+    each sheet, and if it was "cached" when using a cache), "compose"
+    and "write" (bytes, objects of the output). A TraceCollector can
+    be used to record them.
+    """
+
+    if isinstance(n, tuple):
+        assert len(n) == 2 and min(n) > 0
+    else:
+        assert isSquare(n) or isHalfSquare(n)
+
+    if isinstance(inPathOrFile, str):
+        inPathOrFile = pathlib.Path(inPathOrFile)
+    inputs = _inputList(inPathOrFile)
+    outFile = outPathPatternOrFile
+
+    if outPathPatternOrFile is None:
+        if isinstance(inPathOrFile, pathlib.Path):
+            outFile = _defaultOutPath(inPathOrFile, n)
+        elif len(inputs) > 1:
+            raise AssertionError("Must specify output for several inputs!")
+        else:
+            raise AssertionError("Must specify output for file input!")
+    elif isinstance(outPathPatternOrFile, str):
+        outFile = pathlib.Path(outPathPatternOrFile)
+    if isinstance(outFile, pathlib.Path) and _isInput(outFile, inputs):
+        raise ValueError(f"Output is one of the inputs: {str(outFile)!r}")
+
+    _importPypdf()
+    profile = _outputProfile(profile, precision)
+    if profile["objectStreams"]:
+        streaming = True
+    if cache is not None:
+        streaming = True
+        if not isinstance(cache, SheetCache):
+            cache = SheetCache(cache)
+
+    with contextlib.ExitStack() as stack:
+        # get info about source documents
+        with _phase(on_event, "read") as info:
+            sourcePages = stack.enter_context(
+                _InputPages(inputs, max_open, max_memory, mmap_input))
+            numPages = len(sourcePages)
+            pageNums = select_pages(pages, numPages)
+            numSelected = len(pageNums)
+            pageNums = _repeatPages(pageNums, repeat)
+            if on_event is not None:
+                info.update(bytes=sourcePages.bytes,
+                            objects=sourcePages.firstNum - 1, pages=numPages)
+
+        with _phase(on_event, "plan") as info:
+            if plan is None:
+                if streaming:
+                    geometries = _streamGeometries(sourcePages, pageNums)
+                else:
+                    geometries = _geometries(sourcePages, pageNums)
+                plan = plan_nup(geometries, n, dirs, fit)
+            elif plan.numPages != len(pageNums):
+                raise ValueError("Plan does not match the number of pages!")
+            if on_event is not None:
+                info.update(sheets=plan.numSheets)
+
+        if processes > 1 and cache is None and len(inputs) == 1:
+            with _phase(on_event, "compose") as info:
+                _writeParallel(sourcePages.reader(0), sourcePages.inputs[0],
+                               plan, pageNums, outFile, processes, profile,
+                               mmap_input)
+                if on_event is not None:
+                    info.update(processes=processes)
+        else:
+            if streaming:
+                outStream = stack.enter_context(_openOutput(outFile))
+                output = _streamWriter(
+                    outStream, sourcePages.firstNum, plan, profile,
+                    renumber=cache is not None)
+            else:
+                output = PdfWriter()
+
+            with _phase(on_event, "compose"):
+                if on_event is not None:
+                    start = time.perf_counter()
+                    objects, pos = _objectCount(output), 0
+                if cache is not None:
+                    sheets = _cachedSheets(sourcePages, pageNums, plan,
+                                           profile, cache)
+                else:
+                    pool = _ResourcePool(output, profile, sourcePages.sources)
+                    sheets = _composeSheets(sourcePages, pageNums, plan, pool)
+                for index, sheet in enumerate(sheets):
+                    if cache is not None:
+                        output.addSheetEntry(sheet)
+                    else:
+                        output.add_page(sheet)
+                    if streaming:
+                        # everything needed for this sheet is written, so drop
+                        # the source objects parsed for it
+                        sourcePages.clearCaches()
+                    if on_event is not None:
+                        end = time.perf_counter()
+                        info = {"index": index,
+                                "objects": _objectCount(output) - objects}
+                        if streaming:
+                            info["bytes"] = output.pos - pos
+                            pos = output.pos
+                        if cache is not None:
+                            info["cached"] = sheet.cached
+                        on_event("sheet", start, end, info)
+                        start, objects = end, _objectCount(output)
+
+            with _phase(on_event, "write") as info:
+                if streaming:
+                    output.close()
+                    if outStream is not outFile:
+                        outStream.close()
+                    size = output.pos
+                elif isinstance(outFile, io.IOBase):
+                    start = _tell(outFile) if on_event is not None else None
+                    output.write(outFile)
+                    if start is not None:
+                        size = _tell(outFile) - start
+                    else:
+                        size = None
+                else:
+                    with _openOutput(outFile) as file:
+                        output.write(file)
+                        size = file.tell()
+                if on_event is not None:
+                    info.update(bytes=size, objects=_objectCount(output))
+
+    if verbose:
+        if isinstance(outFile, io.IOBase):
+            print("written to file-like output parameter")
+        else:
+            print(f"written: {outFile}")
+
+    return numSelected
+
+
+def iter_nup_sheets(
+    inPathOrFile: io.IOBase | pathlib.Path | str | bytes | memoryview | list,
+    n: int | tuple[int, int],
+    dirs="RD",
+    fit: bool = False,
+    pages=None,
+    plan: "NupPlan | None" = None,
+    profile: str = "fast",
+    precision: int | None = None,
+    output: str = "page",
+    max_memory: int | None = None,
+    max_open: int = 8,
+    repeat: int = 1,
+    mmap_input: bool = False,
+):
+    """Yield the sheets of a N-up document version one at a time.
+
+    The arguments are as for generateNup(). Sheets are planned and
+    composed only when the next one is asked for, so the first sheet
+    is ready after reading the pages it shows, no matter how long the
+    document is.
+
+    If output is "page", the sheets are PageObjects, which can be added
+    to any PdfWriter. The Form XObjects and contents they refer to
+    belong to one PdfWriter, kept for all sheets, so resources shared
+    by several sheets are copied only once. If output is "pdf", every
+    sheet is yielded as the bytes of a single page PDF document with
+    all resources it needs.
+    """
+
+    if isinstance(n, tuple):
+        assert len(n) == 2 and min(n) > 0
+    else:
+        assert isSquare(n) or isHalfSquare(n)
+    if output not in ("page", "pdf"):
+        raise ValueError(f"Unknown output {output!r}!")
+
+    inputs = _inputList(inPathOrFile)
+    _importPypdf()
+    profile = _outputProfile(profile, precision)
+
+    with _InputPages(
+            inputs, max_open, max_memory, mmap_input) as sourcePages:
+        pageNums = _repeatPages(select_pages(pages, len(sourcePages)), repeat)
+        if not pageNums:
+            raise ValueError("Cannot plan a document without pages!")
+        if plan is None:
+            geometries = _geometries(sourcePages, pageNums[:1])
+            plan, slotRects = _emptyPlan(
+                geometries[0], n, dirs, len(pageNums))
+        elif plan.numPages != len(pageNums):
+            raise ValueError("Plan does not match the number of pages!")
+        else:
+            slotRects = None
+
+        if output == "page":
+            pool = _ResourcePool(PdfWriter(), profile, sourcePages.sources)
+        for sheet in range(-(-len(pageNums) // plan.n)):
+            if slotRects is not None:
+                # plan the pages of this sheet only
+                nums = pageNums[len(plan):len(plan) + plan.n]
+                geometries = _geometries(sourcePages, nums)
+                _addTiles(plan, geometries, slotRects, fit)
+            if output == "pdf":
+                builder = _SheetBuilder()
+                pool = _ResourcePool(builder, profile, sourcePages.sources)
+            page, = _composeSheets(
+                sourcePages, pageNums, plan, pool, sheet, sheet + 1)
+            # the sheet only refers to copies of source objects now
+            sourcePages.clearCaches()
+            if output == "page":
+                yield page
+            else:
+                stream = io.BytesIO()
+                writer = _PdfStreamWriter(
+                    stream, 1, level=profile["level"],
+                    objectStreams=profile["objectStreams"])
+                writer.addSheetEntry(builder.entry(page, str(sheet)))
+                writer.close()
+                yield stream.getvalue()
+
+
+class _WorkerPool:
+    """A pool of worker processes recovering when a worker dies.
+
+    A ProcessPoolExecutor whose worker dies, e.g. killed for using too
+    much memory or by a crash, fails all unfinished jobs with
+    BrokenProcessPool and refuses new ones. Here, a new executor is
+    started instead, and the jobs lost are run again one at a time in
+    an executor of their own, so that only a job killing its worker
+    even then fails, with BrokenProcessPool. Jobs are submitted as to
+    a ProcessPoolExecutor.
+    """
+
+    def __init__(self, workers=None, initializer=None):
+        self.workers = workers
+        self.initializer = initializer
+        # callbacks may run right away while it is held
+        self.lock = threading.RLock()
+        self.pending = set()
+        self.executor = self._newExecutor(workers)
+        self.executors = [self.executor]
+        # (future, fn, args) of lost jobs, and the one run alone
+        self.lost = collections.deque()
+        self.isolated = None
+        self.isolating = False
+
+    def _newExecutor(self, workers):
+        import concurrent.futures
+
+        return concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=self.initializer)
+
+    def submit(self, fn, *args):
+        "Run fn(*args) in a worker, returning a Future of the result."
+
+        import concurrent.futures
+
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+        with self.lock:
+            self.pending.add(future)
+            self._submit(future, fn, args)
+        future.add_done_callback(self._forget)
+
+        return future
+
+    def _submit(self, future, fn, args):
+        from concurrent.futures.process import BrokenProcessPool
+
+        executor = self.executor
+        try:
+            job = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            executor = self._replace(executor)
+            job = executor.submit(fn, *args)
+        job.add_done_callback(functools.partial(
+            self._done, future, fn, args, executor))
+
+    def _forget(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    def _replace(self, executor):
+        "Start a new executor instead of a broken one, if not done yet."
+
+        if self.executor is executor:
+            self.executor = self._newExecutor(self.workers)
+            self.executors.append(self.executor)
+
+        return self.executor
+
+    def _done(self, future, fn, args, executor, job):
+        from concurrent.futures.process import BrokenProcessPool
+
+        error = job.exception()
+        if isinstance(error, BrokenProcessPool):
+            with self.lock:
+                self._replace(executor)
+                self.lost.append((future, fn, args))
+                self._isolateNext()
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(job.result())
+
+    def _isolateNext(self):
+        "Run the next lost job alone, if none is running."
+
+        if self.isolating or not self.lost:
+            return
+        future, fn, args = self.lost.popleft()
+        if self.isolated is None:
+            self.isolated = self._newExecutor(1)
+            self.executors.append(self.isolated)
+        self.isolating = True
+        self.isolated.submit(fn, *args).add_done_callback(
+            functools.partial(self._isolatedDone, future))
+
+    def _isolatedDone(self, future, job):
+        from concurrent.futures.process import BrokenProcessPool
+
+        error = job.exception()
+        with self.lock:
+            if isinstance(error, BrokenProcessPool):
+                # this job killed its worker
+                self.isolated = None
+            self.isolating = False
+            self._isolateNext()
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(job.result())
+
+    def shutdown(self, wait=True):
+        "Release the worker processes, after finishing all jobs if wait."
+
+        import concurrent.futures
+
+        if wait:
+            with self.lock:
+                pending = list(self.pending)
+            concurrent.futures.wait(pending)
+        with self.lock:
+            executors = list(self.executors)
+        for executor in executors:
+            executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.shutdown()
+
+
+def _nupJob(job):
+    "Run a single generateNup job, catching and returning any error."
+
+    path, n, kwargs = job
+    startTime = time.perf_counter()
+    try:
+        numPages = generateNup(path, n, **kwargs)
+    except Exception as e:
+        duration = time.perf_counter() - startTime
+        return path, 0, duration, f"{type(e).__name__}: {e}"
+    duration = time.perf_counter() - startTime
+
+    return path, numPages, duration, None
+
+
+def generateNupBatch(paths, n, jobs=1, **kwargs):
+    """Generate N-up versions of many documents, using several processes.
+
+    Yield a (path, numPages, seconds, error) tuple for every document
+    when it is finished, in order of completion. Failures are isolated,
+    i.e. an error in one document is returned as a message in its tuple
+    and does not stop the others, even if it kills its process. If jobs
+    is None, one process per CPU is used. Any other keyword arguments
+    are passed to generateNup.
+    """
+
+    import concurrent.futures
+
+    jobList = ((path, n, kwargs) for path in paths)
+    if jobs == 1:
+        yield from map(_nupJob, jobList)
+        return
+
+    # only keep a few jobs per process in flight to bound memory use
+    # for a very large number of paths
+    with _WorkerPool(jobs) as pool:
+        maxPending = 4 * (jobs or os.cpu_count() or 1)
+        pending = {}
+        for job in jobList:
+            pending[pool.submit(_nupJob, job)] = job[0]
+            if len(pending) >= maxPending:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield _jobResult(future, pending.pop(future))
+        for future in concurrent.futures.as_completed(pending):
+            yield _jobResult(future, pending[future])
+
+
+def _jobResult(future, path):
+    "Return the result of a finished job, or the error it failed with."
+
+    try:
+        return future.result()
+    except Exception as e:
+        return path, 0, 0.0, f"{type(e).__name__}: {e}"
+
+
+class _QueueWriter(io.RawIOBase):
+    """A write-only stream passing chunks of data to an asyncio queue.
+
+    It is written to from another thread, which blocks while the queue
+    is full, so a slow consumer slows down the producer.
+    """
+
+    def __init__(self, queue, loop, chunkSize):
+        self.queue = queue
+        self.loop = loop
+        self.chunkSize = chunkSize
+        self.buf = bytearray()
+        self.cancelled = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buf += data
+        if len(self.buf) >= self.chunkSize:
+            self._put(bytes(self.buf))
+            self.buf.clear()
+        return len(data)
+
+    def _put(self, item):
+        import asyncio
+
+        if self.cancelled:
+            raise OSError("Consumer of output stream has gone away!")
+        put = self.queue.put(item)
+        asyncio.run_coroutine_threadsafe(put, self.loop).result()
+
+    def finish(self):
+        "Send the remaining data and an end marker to the queue."
+
+        try:
+            if self.buf:
+                self._put(bytes(self.buf))
+        finally:
+            if not self.cancelled:
+                self._put(None)
+
+
+def _nupToStream(data, n, stream, kwargs):
+    "Write a N-up version of some PDF code to a _QueueWriter."
+
+    try:
+        return generateNup(io.BytesIO(data), n, stream, **kwargs)
+    finally:
+        stream.finish()
+
+
+def _nupBytes(data, n, kwargs, spoolMemory=None):
+    """Return a N-up version of some PDF code (in some process).
+
+    It is returned as by OutputSpool.release(), so output larger than
+    spoolMemory bytes is passed back as a file.
+    """
+
+    with OutputSpool(spoolMemory) as output:
+        generateNup(io.BytesIO(data), n, output, **kwargs)
+        return output.release()
+
+
+def _releaseWhenDone(limiter, future):
+    "Release a limiter once a job is done, retrieving any error of it."
+
+    if not future.cancelled():
+        # nobody may be waiting for the job any more to see it
+        future.exception()
+    limiter.release()
+
+
+def _discardOutput(future):
+    "Remove any temporary file of a job's output nobody will read."
+
+    if not future.cancelled() and future.exception() is None:
+        OutputSpool._adopt(future.result()).close()
+
+
+async def _readAsync(source):
+    "Return all bytes of bytes, an async stream or an async iterator."
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    elif hasattr(source, "read"):
+        chunks = []
+        while True:
+            chunk = await source.read(1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    return b"".join([chunk async for chunk in source])
+
+
+# limits for generate_nup_async per event loop, if none is given
+_asyncLimiters = weakref.WeakKeyDictionary()
+
+
+async def generate_nup_async(
+    source,
+    n,
+    *,
+    executor=None,
+    limiter=None,
+    chunk_size: int = 1 << 16,
+    spool_memory: int | None = None,
+    **kwargs,
+):
+    """Generate a N-up document version without blocking the event loop.
+
+    This is an async generator yielding the bytes of the output PDF in
+    chunks of about chunk_size bytes. source is the input PDF code as
+    bytes, an async stream with an async read() method (like an
+    asyncio.StreamReader) or an async iterator of bytes.
+
+    The composition runs in executor, by default the event loop's
+    default thread pool. With a thread pool, output is streamed while
+    it is composed, so sending a response can begin before the whole
+    document is done. With a process pool, the document is composed
+    completely in a worker process and then passed back, in a temporary
+    file if it is larger than spool_memory bytes (see OutputSpool). Any
+    other keyword arguments are passed to generateNup.
+
+    limiter is an asyncio.Semaphore (or anything with an async acquire()
+    and a release() method, like an asyncio.Lock) limiting how many
+    documents are composed at the same time. It defaults to one per
+    event loop, allowing one per CPU. It is released when a document
+    is done, which may be after the iterator is closed early.
+    """
+
+    import asyncio
+    import concurrent.futures
+
+    loop = asyncio.get_running_loop()
+    data = await _readAsync(source)
+    if limiter is None:
+        limiter = _asyncLimiters.get(loop)
+        if limiter is None:
+            limiter = asyncio.Semaphore(os.cpu_count() or 1)
+            _asyncLimiters[loop] = limiter
+
+    await limiter.acquire()
+    try:
+        if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+            stream = None
+            future = loop.run_in_executor(
+                executor, _nupBytes, data, n, kwargs, spool_memory)
+        else:
+            queue = asyncio.Queue(maxsize=4)
+            stream = _QueueWriter(queue, loop, chunk_size)
+            kwargs = dict(kwargs, streaming=True)
+            future = loop.run_in_executor(
+                executor, _nupToStream, data, n, stream, kwargs)
+    except BaseException:
+        limiter.release()
+        raise
+    # the job goes on in its thread or process if we stop early
+    future.add_done_callback(functools.partial(_releaseWhenDone, limiter))
+
+    if stream is None:
+        try:
+            result = await asyncio.shield(future)
+        except BaseException:
+            # stopped early, the job may even still be running
+            future.add_done_callback(_discardOutput)
+            raise
+        with OutputSpool._adopt(result) as output:
+            while True:
+                chunk = output.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        return
+
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            yield chunk
+        await asyncio.shield(future)
+    finally:
+        if not future.done():
+            # unblock the producer and make it stop
+            stream.cancelled = True
+            while not queue.empty():
+                queue.get_nowait()
+
+
+# options of generateNup that can be used with a NupServer
+_remoteOptions = ("dirs", "fit", "pages", "profile", "precision", "repeat")
+
+
+def _parseAddress(address):
+    """Return the socket family and address for some address string.
+
+    A string like "HOST:PORT" or just "PORT" is a TCP address (on
+    localhost if HOST is empty), anything else is the path of a
+    Unix-domain socket.
+    """
+
+    import socket
+
+    host, sep, port = address.rpartition(":")
+    if port.isdigit() and os.sep not in host:
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+    return socket.AF_UNIX, address
+
+
+def _isLoopback(host):
+    "Is a host name or IPv4 address one of the local loopback addresses?"
+
+    import ipaddress
+    import socket
+
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def _removeStaleSocket(path):
+    """Remove a Unix-domain socket left behind by a server no longer running.
+
+    Raise FileExistsError if path is something else, or a server is
+    listening on it.
+    """
+
+    import socket
+    import stat
+
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f"Not a socket: {path!r}")
+    with socket.socket(socket.AF_UNIX) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            os.remove(path)
+            return
+    raise FileExistsError(f"A server is listening on {path!r} already!")
+
+
+def _fileId(path):
+    "Return the device and inode number of some file, or None."
+
+    try:
+        stat = os.lstat(path)
+    except FileNotFoundError:
+        return None
+
+    return stat.st_dev, stat.st_ino
+
+
+def _sendMessage(wfile, header, body=b""):
+    "Write a JSON header and a body of bytes or an OutputSpool to a stream."
+
+    import json
+    import struct
+
+    isSpool = isinstance(body, OutputSpool)
+    size = body.size if isSpool else len(body)
+    header = json.dumps(dict(header, size=size)).encode("utf-8")
+    wfile.write(struct.pack(">I", len(header)) + header)
+    if isSpool:
+        body.sendfile(wfile)
+    elif body:
+        wfile.write(body)
+    wfile.flush()
+
+
+def _readExactly(rfile, size):
+    data = rfile.read(size)
+    if len(data) != size:
+        raise EOFError("Connection closed in the middle of a message!")
+
+    return data
+
+
+# largest JSON header of a message, in bytes
+_maxHeaderSize = 1 << 16
+
+
+def _recvMessage(rfile, maxSize=None):
+    """Read a JSON header and a body of bytes from a stream.
+
+    A ValueError is raised, before reading it, for a body larger than
+    maxSize bytes or a header larger than _maxHeaderSize.
+    """
+
+    import json
+    import struct
+
+    prefix = rfile.read(4)
+    if not prefix:
+        raise EOFError("Connection closed.")
+    size, = struct.unpack(">I", prefix + _readExactly(rfile, 4 - len(prefix)))
+    if size > _maxHeaderSize:
+        raise ValueError(f"Message header of {size} bytes is too large!")
+    header = json.loads(_readExactly(rfile, size))
+    size = header.get("size", 0)
+    if not isinstance(size, int) or size < 0:
+        raise ValueError(f"Invalid message size: {size!r}")
+    if maxSize is not None and size > maxSize:
+        raise ValueError(f"Message of {size} bytes is too large!")
+
+    return header, _readExactly(rfile, size)
+
+
+def _warmWorker():
+    "Prepare a server worker process by running a first, tiny job."
+
+    import signal
+
+    # interrupts are handled by the server, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    generateNup(_mtA4PdfCode(), 2, io.BytesIO())
+
+
+def _serveJob(data, n, kwargs, maxMemory=None):
+    """Run a server job, returning the output or an error message.
+
+    The output is returned as by OutputSpool.release().
+    """
+
+    with OutputSpool(maxMemory) as output:
+        try:
+            numPages = generateNup(data, n, output, **kwargs)
+        except Exception as e:
+            return None, 0, f"{type(e).__name__}: {e}"
+
+        return output.release(), numPages, None
+
+
+@functools.lru_cache(maxsize=None)
+def _serverClasses():
+    "Return the request handler and TCP and Unix-domain server classes."
+
+    import socketserver
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        "Handle the requests of one client connection to a NupServer."
+
+        def handle(self):
+            nupServer = self.server.nupServer
+            while True:
+                try:
+                    header, data = _recvMessage(
+                        self.rfile, nupServer.maxRequest)
+                except (EOFError, ValueError, OSError):
+                    return
+                reply, body = nupServer.handleRequest(header, data)
+                try:
+                    _sendMessage(self.wfile, reply, body)
+                except OSError:
+                    # the client has gone away
+                    return
+                finally:
+                    if isinstance(body, OutputSpool):
+                        body.close()
+
+    class TCPServer(socketserver.ThreadingTCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    if hasattr(socketserver, "ThreadingUnixStreamServer"):
+        class UnixServer(socketserver.ThreadingUnixStreamServer):
+            daemon_threads = True
+    else:
+        UnixServer = None
+
+    return RequestHandler, TCPServer, UnixServer
+
+
+class NupServer:
+    """Serve generateNup jobs with pre-warmed worker processes.
+
+    Clients connect to a Unix-domain socket or a localhost TCP port
+    (see _parseAddress) and send requests, which are a JSON header and
+    a body of bytes, both length-prefixed. A request {"op": "nup", "n":
+    4, "options": {...}} with the input PDF as its body is answered by
+    {"ok": true, "pages": numPages} and the output PDF, or by {"ok":
+    false, "error": message}. {"op": "stats"} returns statistics like
+    queue depth and latencies. Use nup_remote() as a client.
+
+    As there is no authentication, TCP hosts other than loopback
+    addresses are refused unless allow_remote is set. Connections
+    sending a body larger than max_request bytes (256 MiB by default)
+    are closed without reading it. A Unix-domain socket path is only
+    taken over from a server no longer running, other files are never
+    removed.
+
+    Workers import everything and run a first job when starting, so
+    requests don't pay for interpreter startup and imports. Outputs
+    larger than max_memory bytes are passed from workers in temporary
+    files and sent from there by the kernel (see OutputSpool).
+    """
+
+    # number of recent jobs used for latency statistics
+    latencyWindow = 1000
+
+    # default of max_request
+    maxRequest = 1 << 28
+
+    def __init__(self, address, workers=None, max_memory=None,
+                 allow_remote=False, max_request=None):
+        import concurrent.futures
+
+        family, sockAddress = _parseAddress(address)
+        if not isinstance(sockAddress, str) and not allow_remote:
+            if not _isLoopback(sockAddress[0]):
+                raise ValueError(f"Not a loopback address: {address!r}, "
+                                 "use allow_remote to serve on it!")
+        if isinstance(sockAddress, str):
+            _removeStaleSocket(sockAddress)
+        self.address = address
+        self.workers = workers or os.cpu_count() or 1
+        self.maxMemory = max_memory
+        if max_request is not None:
+            self.maxRequest = max_request
+        self.lock = threading.Lock()
+        self.startTime = time.time()
+        self.submitted = self.completed = self.failed = 0
+        self.latencies = collections.deque(maxlen=self.latencyWindow)
+
+        self.pool = _WorkerPool(self.workers, initializer=_warmWorker)
+        # start all workers now rather than on the first requests
+        concurrent.futures.wait(
+            [self.pool.submit(time.sleep, 0) for i in range(self.workers)])
+
+        handlerClass, tcpServerClass, unixServerClass = _serverClasses()
+        if isinstance(sockAddress, str):
+            serverClass = unixServerClass
+            if serverClass is None:
+                raise ValueError("Unix-domain sockets are not supported!")
+        else:
+            serverClass = tcpServerClass
+        self.server = serverClass(sockAddress, handlerClass)
+        self.server.nupServer = self
+        # the socket created, if a Unix-domain one
+        self.socketId = None
+        if isinstance(sockAddress, str):
+            self.socketId = _fileId(sockAddress)
+
+    def handleRequest(self, header, data):
+        "Return a reply header and body for some request."
+
+        op = header.get("op")
+        if op == "stats":
+            return {"ok": True, "stats": self.stats()}, b""
+        elif op != "nup":
+            return {"ok": False, "error": f"Unknown operation: {op!r}"}, b""
+
+        n = header.get("n", 4)
+        n = tuple(n) if isinstance(n, list) else n
+        options = header.get("options", {})
+        kwargs = {k: v for k, v in options.items() if k in _remoteOptions}
+        startTime = time.perf_counter()
+        with self.lock:
+            self.submitted += 1
+        try:
+            future = self.pool.submit(
+                _serveJob, data, n, kwargs, self.maxMemory)
+            output, numPages, error = future.result()
+        except Exception as e:
+            output, numPages, error = None, 0, f"{type(e).__name__}: {e}"
+        latency = time.perf_counter() - startTime
+        with self.lock:
+            self.completed += 1
+            self.failed += error is not None
+            self.latencies.append(latency)
+
+        if error is not None:
+            return {"ok": False, "error": error}, b""
+
+        return {"ok": True, "pages": numPages}, OutputSpool._adopt(output)
+
+    def stats(self):
+        "Return a dict of statistics about jobs and their latencies."
+
+        with self.lock:
+            latencies = sorted(self.latencies)
+            inFlight = self.submitted - self.completed
+            stats = {
+                "workers": self.workers,
+                "uptime": time.time() - self.startTime,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "in_flight": inFlight,
+                "queue_depth": max(0, inFlight - self.workers),
+            }
+        if latencies:
+            def percentile(p):
+                return latencies[min(len(latencies) - 1,
+                                     int(p / 100 * len(latencies)))]
+            stats.update(
+                latency_mean=sum(latencies) / len(latencies),
+                latency_p50=percentile(50),
+                latency_p95=percentile(95),
+                latency_max=latencies[-1])
+
+        return stats
+
+    def serve_forever(self):
+        "Handle requests until shutdown() is called."
+
+        self.server.serve_forever()
+
+    def shutdown(self):
+        "Stop serving, from another thread."
+
+        self.server.shutdown()
+
+    def close(self):
+        "Release the socket and the worker processes."
+
+        self.server.server_close()
+        self.pool.shutdown()
+        family, sockAddress = _parseAddress(self.address)
+        if self.socketId is not None and _fileId(sockAddress) == self.socketId:
+            os.remove(sockAddress)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.close()
+
+
+def _connect(address):
+    "Return a socket connected to a NupServer."
+
+    import socket
+
+    family, sockAddress = _parseAddress(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.connect(sockAddress)
+    except OSError:
+        sock.close()
+        raise
+
+    return sock
+
+
+def _request(address, header, body=b""):
+    "Send a request to a NupServer and return its reply."
+
+    with _connect(address) as sock, sock.makefile("rwb") as file:
+        _sendMessage(file, header, body)
+        reply, data = _recvMessage(file)
+    if not reply.get("ok"):
+        raise RuntimeError(f"Server job failed: {reply.get('error')}")
+
+    return reply, data
+
+
+def nup_remote(address, data, n, **options):
+    """Generate a N-up document version on a NupServer.
+
+    data is the input PDF code. Options like dirs, fit, pages, profile
+    and precision are passed to generateNup. Return the output PDF code
+    and the number of pages placed, or raise a RuntimeError if the job
+    failed.
+    """
+
+    unknown = set(options) - set(_remoteOptions)
+    if unknown:
+        raise TypeError(f"Unsupported options: {', '.join(sorted(unknown))}")
+    header = {"op": "nup", "n": n, "options": options}
+    reply, output = _request(address, header, bytes(data))
+
+    return output, reply["pages"]
+
+
+def nup_server_stats(address):
+    "Return the statistics of a NupServer."
+
+    reply, data = _request(address, {"op": "stats"})
+
+    return reply["stats"]
+
+
+# inotify event masks, see inotify(7)
+_inModify = 0x2
+_inCloseWrite = 0x8
+_inMovedFrom = 0x40
+_inMovedTo = 0x80
+_inCreate = 0x100
+_inDelete = 0x200
+_inQueueOverflow = 0x4000
+
+
+def _inotify(directory):
+    """Return an inotify file descriptor watching a directory.
+
+    It reports files created, written, moved or deleted there. Return
+    None if inotify is not available, i.e. not on Linux.
+    """
+
+    import ctypes
+    import sys
+
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    mask = (_inModify | _inCloseWrite | _inMovedFrom | _inMovedTo
+            | _inCreate | _inDelete)
+    if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        os.close(fd)
+        return None
+
+    return fd
+
+
+def _inotifyNames(fd):
+    """Return the names of the files in the events waiting on an inotify
+    file descriptor, or None if events were lost.
+    """
+
+    import struct
+
+    names = set()
+    while True:
+        try:
+            data = os.read(fd, 1 << 16)
+        except BlockingIOError:
+            return names
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, size = struct.unpack_from("iIII", data, pos)
+            pos += 16
+            if mask & _inQueueOverflow:
+                return None
+            names.add(os.fsdecode(data[pos:pos+size].rstrip(b"\0")))
+            pos += size
+
+
+class HotFolder:
+    """Generate N-up versions of the PDF files dropped into a directory.
+
+    New PDF files in watch_dir are processed by a pool of worker
+    processes as soon as they are completely written, i.e. their size
+    and modification time have not changed for settle seconds, and the
+    outputs are written to out_dir, named as by generateNup(). Every
+    output is written to a temporary file first and then renamed, so
+    it appears atomically. Files are noticed with inotify on Linux, and
+    else by scanning the directory every poll_interval seconds.
+
+    At most two jobs per worker are in flight, and more files ready to
+    be processed wait in a backlog. Files having an output newer than
+    themselves, e.g. from an earlier run, are skipped, and so are files
+    not changed since they failed. Files changed while waiting or being
+    processed are processed again. on_result is called as on_result(
+    path, outPath, numPages, seconds, error) for every finished file,
+    and stats() returns counters like the backlog and the throughput.
+    Other keyword arguments are passed to generateNup.
+    """
+
+    def __init__(self, watch_dir, out_dir, n=4, workers=None, settle=1.0,
+                 poll_interval=0.5, on_result=None, **options):
+        os.makedirs(out_dir, exist_ok=True)
+        if os.path.samefile(watch_dir, out_dir):
+            raise ValueError("Output directory must not be the watched one!")
+        self.watchDir = watch_dir
+        self.outDir = out_dir
+        self.n = n
+        self.workers = workers or os.cpu_count() or 1
+        self.settle = settle
+        self.pollInterval = poll_interval
+        self.onResult = on_result
+        self.options = options
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.startTime = time.time()
+        self.detected = self.submitted = self.completed = 0
+        self.failed = self.skipped = self.pages = 0
+        # path -> (size, mtime) and time of the last change, for files
+        # that may still be written
+        self.candidates = {}
+        self.backlog = collections.deque()
+        self.inFlight = {}
+        # paths in the backlog or in flight
+        self.queued = set()
+        # path -> (size, mtime) of files processed
+        self.done = {}
+
+        self.pool = _WorkerPool(self.workers, initializer=_warmWorker)
+        self.fd = _inotify(watch_dir)
+        self.watching = "polling" if self.fd is None else "inotify"
+
+    def _signature(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        return stat.st_size, stat.st_mtime_ns
+
+    def _notice(self, names, rescan=False):
+        "Start watching some files of the directory until they are written."
+
+        paths = set()
+        for name in names:
+            if name.startswith(".") or not name.lower().endswith(".pdf"):
+                continue
+            path = os.path.join(self.watchDir, name)
+            paths.add(path)
+            if path in self.candidates or path in self.queued:
+                continue
+            if path in self.done:
+                # unchanged since processed, as rescans list all files
+                if self._signature(path) == self.done[path]:
+                    continue
+            with self.lock:
+                self.candidates[path] = None, None
+        if rescan:
+            # forget files gone
+            for path in set(self.done) - paths:
+                del self.done[path]
+
+    def _check(self, now):
+        "Move files not changed for settle seconds to the backlog."
+
+        for path, (signature, since) in list(self.candidates.items()):
+            newSignature = self._signature(path)
+            if newSignature is None:
+                with self.lock:
+                    del self.candidates[path]
+                self.done.pop(path, None)
+            elif newSignature != signature:
+                with self.lock:
+                    self.candidates[path] = newSignature, now
+            elif now - since >= self.settle and path not in self.queued:
+                with self.lock:
+                    del self.candidates[path]
+                if self.done.get(path) == signature:
+                    continue
+                self.done[path] = signature
+                outPath = os.path.join(
+                    self.outDir, _defaultOutPath(path, self.n).name)
+                try:
+                    upToDate = os.stat(outPath).st_mtime_ns >= signature[1]
+                except FileNotFoundError:
+                    upToDate = False
+                with self.lock:
+                    if upToDate:
+                        self.skipped += 1
+                        continue
+                    self.detected += 1
+                    self.backlog.append((path, outPath))
+                self.queued.add(path)
+
+    def _dispatch(self):
+        "Submit jobs from the backlog while the workers can take them."
+
+        import tempfile
+
+        while self.backlog and len(self.inFlight) < 2 * self.workers:
+            path, outPath = self.backlog[0]
+            fd, tmpPath = tempfile.mkstemp(
+                suffix=".part", prefix=".", dir=self.outDir)
+            os.close(fd)
+            kwargs = dict(self.options, outPathPatternOrFile=tmpPath)
+            future = self.pool.submit(_nupJob, (path, self.n, kwargs))
+            with self.lock:
+                self.backlog.popleft()
+                self.inFlight[future] = path, outPath, tmpPath
+                self.submitted += 1
+
+    def _collect(self, timeout):
+        "Finish the jobs done within some timeout."
+
+        import concurrent.futures
+
+        done, pending = concurrent.futures.wait(
+            self.inFlight, timeout,
+            return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            with self.lock:
+                path, outPath, tmpPath = self.inFlight.pop(future)
+            self.queued.discard(path)
+            # changes while queued or in flight are noticed only now
+            signature = self._signature(path)
+            if signature is None:
+                self.done.pop(path, None)
+            elif signature != self.done.get(path):
+                with self.lock:
+                    self.candidates[path] = None, None
+            path, numPages, duration, error = _jobResult(future, path)
+            if error is None:
+                try:
+                    os.replace(tmpPath, outPath)
+                except OSError as e:
+                    error = f"{type(e).__name__}: {e}"
+            if error is not None:
+                with contextlib.suppress(OSError):
+                    os.remove(tmpPath)
+            with self.lock:
+                self.completed += 1
+                self.failed += error is not None
+                self.pages += numPages
+            if self.onResult is not None:
+                self.onResult(path, outPath, numPages, duration, error)
+
+    def _tick(self):
+        "Wait a little for changes or finished jobs, and handle them."
+
+        if self.inFlight:
+            self._collect(self.pollInterval)
+        elif self.fd is not None and not self.candidates:
+            import select
+
+            select.select([self.fd], [], [], self.pollInterval)
+        else:
+            self.stopping.wait(self.pollInterval)
+
+        names = None if self.fd is None else _inotifyNames(self.fd)
+        if names is None:
+            self._notice(os.listdir(self.watchDir), rescan=True)
+        else:
+            self._notice(names)
+        self._check(time.monotonic())
+        self._dispatch()
+        self._collect(0)
+
+    def serve_forever(self):
+        """Process files until shutdown() is called.
+
+        Files already in the directory are processed first. The backlog
+        left when stopping is processed on the next run.
+        """
+
+        self._notice(os.listdir(self.watchDir), rescan=True)
+        while not self.stopping.is_set():
+            self._tick()
+
+    def shutdown(self):
+        "Stop processing files, from another thread."
+
+        self.stopping.set()
+
+    def stats(self):
+        "Return a dict of counters about files processed and waiting."
+
+        with self.lock:
+            uptime = time.time() - self.startTime
+            return {
+                "workers": self.workers,
+                "watching": self.watching,
+                "uptime": uptime,
+                "detected": self.detected,
+                "skipped": self.skipped,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "pages": self.pages,
+                "in_flight": len(self.inFlight),
+                "backlog": len(self.backlog),
+                "settling": len(self.candidates),
+                "files_per_second": self.completed / uptime,
+                "pages_per_second": self.pages / uptime,
+            }
+
+    def close(self):
+        "Finish the jobs in flight and release the worker processes."
+
+        try:
+            while self.inFlight:
+                self._collect(None)
+        finally:
+            self.pool.shutdown()
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.close()
@@ -39,6 +39,7 @@ Features
 
 - save minimized pages of a given PDF document in a new PDF document
 - place n pages per sheet, with n being square or half square
+- place pages on any rows x cols grid, optionally keeping their ratio
 - customize layout order, both horizontally and vertically
 - turn rotated pages to make them all have the same format 
 - allow patterns for output files
@@ -121,4 +122,5 @@ setup(
     # for setuptools, only
     zip_safe = False,
     install_requires = ["pypdf>=3.3.0"],
+    extras_require = {"numpy": ["numpy"]},
 )
@@ -7,16 +7,45 @@
 import os
 import math
 import unittest
+import unittest.mock
 import io
+import gc
+import functools
+import json
+import pickle
+import asyncio
+import concurrent.futures
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
 try:
     from pypdf import PdfReader as PdfFileReader
     from pypdf import PdfWriter as PdfFileWriter
+    from pypdf import PageObject
+    from pypdf.generic import NameObject
+    from pypdf.generic import DictionaryObject
+    from pypdf.generic import ArrayObject
+    from pypdf.generic import NumberObject
+    from pypdf.generic import DecodedStreamObject
 except ImportError:
     _MSG = "Please install pyPdf first, see http://pybrary.net/pyPdf"
     raise RuntimeError(_MSG)
 
-from pdfnup import generateNup
+import pdfnup
+from pdfnup import generateNup, generateNupBatch
+from pdfnup import plan_nup, pageGeometries
+from pdfnup import generate_nup_async
+from pdfnup import TraceCollector
+from pdfnup import select_pages
+from pdfnup import NupServer, nup_remote, nup_server_stats
+from pdfnup import SheetCache
+from pdfnup import iter_nup_sheets
+from pdfnup import OutputSpool
+from pdfnup import HotFolder
 
 
 def group(seq, groupLen=None):
@@ -155,6 +184,30 @@ class RotationTests(unittest.TestCase):
                 generateNup(outPath, j, verbose=False)
 
 
+class ImportTests(unittest.TestCase):
+    "Tests for importing pdfnup quickly."
+
+    def test0(self):
+        "Test pypdf and other heavy modules are only imported when used."
+
+        code = """if 1:
+            import sys, pdfnup
+            heavy = ["pypdf", "asyncio", "concurrent.futures", "socketserver"]
+            print([m for m in heavy if m in sys.modules])
+            print(pdfnup.calcRects((595, 842), 4)[0])
+            print("pypdf" in sys.modules)
+            print(pdfnup.PdfReader.__name__, pdfnup._mtA4Pdf[:8])
+            print("pypdf" in sys.modules)
+            """
+        proc = subprocess.run([sys.executable, "-c", code], check=True,
+                              capture_output=True, text=True)
+        lines = proc.stdout.splitlines()
+        self.assertEqual(lines[0], "[]")
+        self.assertEqual(lines[2], "False")
+        self.assertEqual(lines[3], "PdfReader b'%PDF-1.3'")
+        self.assertEqual(lines[4], "True")
+
+
 class FileLikeInputTests(unittest.TestCase):
     "Tests with file-like input documents (file or StringIO objects)."
 
@@ -204,6 +257,49 @@ class FileLikeInputTests(unittest.TestCase):
                 generateNup, f, n, None, verbose=False
             )
 
+    def test4(self):
+        "Test using bytes, bytearray and memoryview input."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        with open(path0, "rb") as file:
+            pdfCode = file.read()
+        expected = io.BytesIO()
+        generateNup(path0, n, expected, streaming=True)
+        for data in (pdfCode, bytearray(pdfCode), memoryview(pdfCode),
+                     memoryview(b"xx" + pdfCode)[2:]):
+            for kwargs in ({"streaming": True}, {"processes": 2}):
+                output = io.BytesIO()
+                generateNup(data, n, output, **kwargs)
+                self.assertEqual(output.getvalue(), expected.getvalue())
+        self.assertRaises(AssertionError, generateNup, pdfCode, n, None)
+
+    def test5(self):
+        "Test mapped path inputs and refusing to overwrite an input."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        expected = io.BytesIO()
+        generateNup(path0, n, expected, streaming=True)
+        for kwargs in ({"streaming": True}, {"processes": 2}):
+            output = io.BytesIO()
+            generateNup(path0, n, output, mmap_input=True, **kwargs)
+            self.assertEqual(output.getvalue(), expected.getvalue())
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            path1 = os.path.join(tmpDir, "same.pdf")
+            with open(path0, "rb") as file:
+                pdfCode = file.read()
+            with open(path1, "wb") as file:
+                file.write(pdfCode)
+            for kwargs in ({}, {"streaming": True}, {"profile": "small"}):
+                self.assertRaises(ValueError, generateNup, path1, n,
+                                  path1, **kwargs)
+                self.assertRaises(ValueError, generateNup,
+                                  [path0, path1], n, path1, **kwargs)
+            with open(path1, "rb") as file:
+                self.assertEqual(file.read(), pdfCode)
+
 
 class FileLikeOutputTests(unittest.TestCase):
     "Tests with file-like output documents (file or StringIO objects)."
@@ -237,5 +333,1291 @@ class FileLikeOutputTests(unittest.TestCase):
         self.assertTrue(data.rstrip().endswith(b"%%EOF"))
 
 
+class FormXObjectTests(unittest.TestCase):
+    "Tests for placing source pages as Form XObjects."
+
+    def test0(self):
+        "Test source content streams are reused without being re-encoded."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        output = io.BytesIO()
+        generateNup(path0, n, output, verbose=False)
+        output.seek(0)
+        src = PdfFileReader(path0)
+        dst = PdfFileReader(output)
+        xobjs = dst.pages[0]["/Resources"]["/XObject"]
+        self.assertEqual(len(xobjs), n)
+        for i, name in enumerate(sorted(xobjs)):
+            form = xobjs[name].get_object()
+            self.assertEqual(form["/Subtype"], "/Form")
+            srcContents = src.pages[i]["/Contents"].get_object()
+            self.assertEqual(form._data, srcContents._data)
+
+    def test1(self):
+        "Test repeated pages all draw the same Form XObject."
+
+        n = 8
+        path0 = "samples/test-a4-l.pdf"
+        for kwargs in ({}, {"streaming": True}, {"profile": "small"}):
+            for repeat in (3, 8, 20):
+                output = io.BytesIO()
+                numPages = generateNup(path0, n, output, pages="1-4",
+                                       repeat=repeat, **kwargs)
+                self.assertEqual(numPages, 4)
+                sheets = PdfFileReader(output).pages
+                self.assertEqual(len(sheets), math.ceil(4 * repeat / n))
+                texts = sum((s.extract_text().split() for s in sheets), [])
+                self.assertEqual(
+                    texts, [str(i) for i in range(4) for k in range(repeat)])
+                forms = set()
+                for sheet in sheets:
+                    xObjects = sheet["/Resources"]["/XObject"]
+                    forms.update(dict.__getitem__(xObjects, k).idnum
+                                 for k in xObjects)
+                self.assertEqual(len(forms), 4)
+        self.assertRaises(ValueError, generateNup, path0, n, io.BytesIO(),
+                          repeat=0)
+
+    def test2(self):
+        "Test contents of several compressed parts are kept compressed."
+
+        padding = b"% padding\n" * 2000
+        docs = []
+        for numParts in (1, 2):
+            output = PdfFileWriter()
+            for i in range(16):
+                page = PageObject.create_blank_page(None, 595, 842)
+                data = b"BT /F1 24 Tf 100 400 Td (%d) Tj ET\n" % i + padding
+                parts = [data] if numParts == 1 else [data[:40], data[40:]]
+                refs = []
+                for part in parts:
+                    stream = DecodedStreamObject()
+                    stream.set_data(part)
+                    refs.append(output._add_object(stream.flate_encode()))
+                page[NameObject("/Contents")] = (
+                    refs[0] if numParts == 1 else ArrayObject(refs))
+                output.add_page(page)
+            pdfCode = io.BytesIO()
+            output.write(pdfCode)
+            docs.append(pdfCode.getvalue())
+
+        for profile in ("fast", "balanced", "small"):
+            sizes = []
+            for pdfCode in docs:
+                output = io.BytesIO()
+                generateNup(pdfCode, 4, output, profile=profile)
+                sizes.append(len(output.getvalue()))
+            self.assertLess(sizes[1], sizes[0] * 1.5)
+            self.assertLess(sizes[1], 16 * len(padding) / 4)
+
+
+class PlanTests(unittest.TestCase):
+    "Tests for precomputed layout plans."
+
+    def test0(self):
+        "Test a plan has a sheet, rect and matrix for every page."
+
+        path0 = "samples/test-a4-l.pdf"
+        geometries = pageGeometries(PdfFileReader(path0))
+        for n in (2, 4, 8, 9, 16):
+            plan = plan_nup(geometries, n)
+            self.assertEqual(len(plan), len(geometries))
+            self.assertEqual(plan.numSheets, math.ceil(len(geometries) / n))
+            for i in range(len(plan)):
+                page, sheet, rect, matrix = plan.tile(i)
+                self.assertEqual((page, sheet), (i, i // n))
+                self.assertEqual(len(rect), 4)
+                self.assertEqual(len(matrix), 6)
+            sheets = [(s, list(t)) for s, t in plan.sheetTiles(1, 3)]
+            self.assertEqual(sheets, [
+                (1, list(range(n, 2 * n))), (2, list(range(2 * n, 3 * n)))])
+
+    def test1(self):
+        "Test reusing a plan for several documents of the same shape."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        plan = plan_nup(pageGeometries(PdfFileReader(path0)), n)
+        expected = io.BytesIO()
+        generateNup(path0, n, expected)
+        for i in range(2):
+            output = io.BytesIO()
+            generateNup(path0, n, output, plan=plan)
+            self.assertEqual(output.getvalue(), expected.getvalue())
+
+    def test3(self):
+        "Test rotated pages are placed as shown, i.e. with /Rotate."
+
+        # where the lower left mediabox corner ends up on a 600x800 sheet
+        expected = {0: (0, 0), 90: (0, 800), 180: (600, 800), 270: (600, 0)}
+        x0, y0, x1, y1 = 5, 5, 805, 605
+        for rotation, corner in expected.items():
+            geometries = [(0, 0, 600, 800, 0), (x0, y0, x1, y1, rotation)]
+            for fit in (False, True):
+                plan = plan_nup(geometries, (1, 1), fit=fit)
+                a, b, c, d, e, f = plan.tile(1)[3]
+                xs = [a*x + c*y + e for x in (x0, x1) for y in (y0, y1)]
+                ys = [b*x + d*y + f for x in (x0, x1) for y in (y0, y1)]
+                if fit:
+                    # aspect ratio kept, centered in the tile
+                    self.assertAlmostEqual(abs(a) + abs(b), abs(c) + abs(d))
+                    self.assertAlmostEqual(min(xs), 600 - max(xs))
+                    self.assertAlmostEqual(min(ys), 800 - max(ys))
+                else:
+                    self.assertAlmostEqual(a*x0 + c*y0 + e, corner[0])
+                    self.assertAlmostEqual(b*x0 + d*y0 + f, corner[1])
+                    self.assertEqual(
+                        [round(v, 6) for v in (min(xs), min(ys))], [0, 0])
+                    self.assertEqual(
+                        [round(v, 6) for v in (max(xs), max(ys))], [600, 800])
+
+    def test4(self):
+        "Test generating documents with arbitrary rows x cols grids."
+
+        path0 = "samples/test-legal-p.pdf"
+        np0 = len(PdfFileReader(path0).pages)
+        for grid in ((3, 2), (1, 5), (4, 1)):
+            for fit in (False, True):
+                output = io.BytesIO()
+                generateNup(path0, grid, output, fit=fit)
+                output.seek(0)
+                input = PdfFileReader(output)
+                n = grid[0] * grid[1]
+                self.assertEqual(len(input.pages), math.ceil(np0 / n))
+                text = input.pages[0].extract_text().split()
+                self.assertEqual(text, [str(i) for i in range(n)])
+
+    def test5(self):
+        "Test vectorized transforms equal those computed page by page."
+
+        if pdfnup._numpy() is None:
+            self.skipTest("NumPy is not installed")
+        geometries = [
+            (i % 3 * 5, 0, 595 + i % 2 * 247, 842, i % 5 * 90)
+            for i in range(300)]
+        minPages = pdfnup._vectorizeMinPages
+        try:
+            for fit in (False, True):
+                plans = []
+                for pdfnup._vectorizeMinPages in (1, len(geometries) + 1):
+                    plans.append(plan_nup(geometries, 8, "LU", fit))
+                self.assertEqual(plans[0].matrices, plans[1].matrices)
+        finally:
+            pdfnup._vectorizeMinPages = minPages
+
+    def test2(self):
+        "Test a plan for a different number of pages is refused."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        plan = plan_nup([(100, 100, 0)] * 3, n)
+        output = io.BytesIO()
+        self.assertRaises(
+            ValueError, generateNup, path0, n, output, plan=plan)
+
+
+class StreamingTests(unittest.TestCase):
+    "Tests for writing output documents incrementally."
+
+    def test0(self):
+        "Test streaming output has the same pages as in-memory output."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        outputs = []
+        for streaming in (False, True):
+            output = io.BytesIO()
+            generateNup(path0, n, output, streaming=streaming)
+            output.seek(0)
+            outputs.append(PdfFileReader(output, strict=True))
+        expected, streamed = outputs
+        self.assertEqual(len(streamed.pages), len(expected.pages))
+        for page0, page1 in zip(expected.pages, streamed.pages):
+            self.assertEqual(page0.extract_text(), page1.extract_text())
+            self.assertEqual(page0.mediabox, page1.mediabox)
+
+    def test1(self):
+        "Test streaming from a non-seekable input stream."
+
+        class Pipe(io.RawIOBase):
+            def __init__(self, data):
+                self.buf = io.BytesIO(data)
+
+            def readable(self):
+                return True
+
+            def readinto(self, b):
+                return self.buf.readinto(b)
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        with open(path0, "rb") as file:
+            pdfCode = file.read()
+        output = io.BytesIO()
+        generateNup(Pipe(pdfCode), n, output, streaming=True, max_memory=1024)
+        output.seek(0)
+        np0 = len(PdfFileReader(path0).pages)
+        self.assertEqual(len(PdfFileReader(output).pages), math.ceil(np0 / n))
+
+    def test2(self):
+        "Test composing in several processes gives the same document."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        outputs = []
+        for kwargs in ({"streaming": True}, {"processes": 3}):
+            output = io.BytesIO()
+            generateNup(path0, n, output, **kwargs)
+            outputs.append(output.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test3(self):
+        "Test no partial output file is left after an error."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        with tempfile.TemporaryDirectory() as tmpDir:
+            path1 = os.path.join(tmpDir, "out.pdf")
+            with unittest.mock.patch.object(
+                    pdfnup, "_composeSheet", side_effect=RuntimeError):
+                self.assertRaises(RuntimeError, generateNup, path0, n, path1,
+                                  streaming=True)
+            self.assertEqual(os.listdir(tmpDir), [])
+
+        # pages are not kept once used
+        tree = pdfnup._PageTree(PdfFileReader(path0))
+        self.assertIsNot(tree[1], tree[1])
+
+    def test4(self):
+        "Test no chunk files are left after an error in some process."
+
+        n = 4
+        output = PdfFileWriter()
+        for i in range(20):
+            page = PageObject.create_blank_page(None, 595, 842)
+            stream = DecodedStreamObject()
+            stream.set_data(b"BT /F1 24 Tf 100 400 Td (%d) Tj ET" % i)
+            if i == 0:
+                # cannot be decoded when joining the parts
+                stream[NameObject("/Filter")] = NameObject("/Unknown")
+            page[NameObject("/Contents")] = ArrayObject(
+                [output._add_object(stream)] * 2)
+            output.add_page(page)
+        with tempfile.TemporaryDirectory() as tmpDir:
+            path = os.path.join(tmpDir, "in.pdf")
+            with open(path, "wb") as file:
+                output.write(file)
+            chunkDir = os.path.join(tmpDir, "chunks")
+            os.mkdir(chunkDir)
+            with unittest.mock.patch.object(tempfile, "tempdir", chunkDir):
+                self.assertRaises(NotImplementedError, generateNup, path, n,
+                                  io.BytesIO(), processes=4)
+            self.assertEqual(os.listdir(chunkDir), [])
+
+
+class ResourcePoolTests(unittest.TestCase):
+    "Tests for sharing identical resources across sheets."
+
+    def test0(self):
+        "Test identical fonts stored once per page are written only once."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        output = PdfFileWriter()
+        for page in PdfFileReader(path0).pages:
+            page = output.add_page(page)
+            # give every page its own copy of the same font
+            fonts = DictionaryObject(page["/Resources"]["/Font"])
+            for name in list(fonts):
+                font = DictionaryObject(fonts[name])
+                fonts[name] = output._add_object(font)
+            page["/Resources"][NameObject("/Font")] = fonts
+        input = io.BytesIO()
+        output.write(input)
+        input.seek(0)
+        fontRefs = set()
+        for page in PdfFileReader(input).pages:
+            fonts = page["/Resources"]["/Font"]
+            fontRefs.update(dict.__getitem__(fonts, k).idnum for k in fonts)
+        self.assertEqual(len(fontRefs), 50)
+
+        for streaming in (False, True):
+            input.seek(0)
+            result = io.BytesIO()
+            generateNup(input, n, result, streaming=streaming)
+            result.seek(0)
+            fontRefs = set()
+            for page in PdfFileReader(result).pages:
+                for form in page["/Resources"]["/XObject"].values():
+                    fonts = form.get_object()["/Resources"]["/Font"]
+                    fontRefs.update(
+                        dict.__getitem__(fonts, k).idnum for k in fonts)
+            self.assertEqual(len(fontRefs), 1)
+
+    def test1(self):
+        "Test resource names needing escapes are written escaped."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        output = PdfFileWriter()
+        for page in PdfFileReader(path0).pages:
+            page = output.add_page(page)
+            fonts = page["/Resources"]["/Font"]
+            fonts = DictionaryObject(
+                (NameObject(k + " #"), v) for k, v in fonts.items())
+            page["/Resources"][NameObject("/Font")] = fonts
+        input = io.BytesIO()
+        output.write(input)
+
+        for streaming in (False, True):
+            input.seek(0)
+            result = io.BytesIO()
+            generateNup(input, n, result, streaming=streaming)
+            self.assertIn(b"#20#23", result.getvalue())
+            result.seek(0)
+            for page in PdfFileReader(result).pages:
+                for form in page["/Resources"]["/XObject"].values():
+                    fonts = form.get_object()["/Resources"]["/Font"]
+                    for name in fonts:
+                        self.assertTrue(name.endswith(" #"))
+
+
+class BatchTests(unittest.TestCase):
+    "Tests for processing many documents in parallel."
+
+    def test0(self):
+        "Test failures are isolated and reported per document."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        with open(path0, "rb") as file:
+            pdfCode = file.read()
+        with tempfile.TemporaryDirectory() as tmpDir:
+            paths = []
+            for name in ("a.pdf", "b.pdf", "bad.pdf"):
+                paths.append(os.path.join(tmpDir, name))
+                with open(paths[-1], "wb") as file:
+                    file.write(b"junk" if name == "bad.pdf" else pdfCode)
+            results = list(generateNupBatch(paths, n, jobs=2))
+            self.assertEqual(sorted(r[0] for r in results), sorted(paths))
+            for path, numPages, duration, error in results:
+                if path.endswith("bad.pdf"):
+                    self.assertTrue(error)
+                else:
+                    self.assertIsNone(error)
+                    self.assertEqual(numPages, 50)
+                    self.assertTrue(os.path.exists(path[:-4] + "-4up.pdf"))
+
+    def test1(self):
+        "Test a document killing its process fails only itself."
+
+        n = 4
+        paths = []
+        with tempfile.TemporaryDirectory() as tmpDir:
+            for i in range(12):
+                paths.append(os.path.join(tmpDir, f"{i}.pdf"))
+                path0 = "samples/test-a4-l.pdf"
+                if i == 5:
+                    # the only one having 13 pages
+                    path0 = "samples/test-a4-l-4up.pdf"
+                with open(path0, "rb") as src, open(paths[-1], "wb") as dst:
+                    dst.write(src.read())
+            onEvent = functools.partial(_exitOnPages, 13)
+            results = list(generateNupBatch(paths, n, jobs=2,
+                                            on_event=onEvent))
+            self.assertEqual(sorted(r[0] for r in results), sorted(paths))
+            for path, numPages, duration, error in results:
+                if path == paths[5]:
+                    self.assertIn("BrokenProcessPool", error)
+                else:
+                    self.assertIsNone(error)
+                    self.assertEqual(numPages, 50)
+
+    def test2(self):
+        "Test the worker pool keeps working after a worker died."
+
+        with pdfnup._WorkerPool(2) as pool:
+            futures = [pool.submit(time.sleep, 0.2) for i in range(4)]
+            crash = pool.submit(os._exit, 1)
+            futures += [pool.submit(time.sleep, 0.2) for i in range(4)]
+            self.assertRaises(concurrent.futures.process.BrokenProcessPool,
+                              crash.result)
+            for future in futures:
+                self.assertIsNone(future.result())
+            self.assertEqual(pool.submit(abs, -1).result(), 1)
+
+
+def _exitOnPages(numPages, name, start, end, info):
+    "An on_event handler killing its process when reading numPages pages."
+
+    if name == "read" and info.get("pages") == numPages:
+        os._exit(1)
+
+
+def _nestedPageTree(numPages, fanout):
+    """Return PDF code with a page tree fanout nodes wide at every level.
+
+    Page tree nodes, not the pages, carry the page size and rotation,
+    which pages inherit.
+    """
+
+    output = PdfFileWriter()
+    for i in range(numPages):
+        page = PageObject.create_blank_page(None, 100 + i, 200)
+        del page["/MediaBox"]
+        output.add_page(page)
+    refs = [page.indirect_reference for page in output.pages]
+    counts = [1] * numPages
+    level = 0
+    while len(refs) > 1 or level == 0:
+        nodes, nodeCounts = [], []
+        for i in range(0, len(refs), fanout):
+            node = DictionaryObject({
+                NameObject("/Type"): NameObject("/Pages"),
+                NameObject("/Kids"): ArrayObject(refs[i:i+fanout]),
+                NameObject("/Count"): NumberObject(sum(counts[i:i+fanout])),
+            })
+            if level == 0:
+                node[NameObject("/MediaBox")] = ArrayObject(
+                    NumberObject(x) for x in (0, 0, 100 + i, 200))
+            if level == 1:
+                node[NameObject("/Rotate")] = NumberObject(90)
+            ref = output._add_object(node)
+            for kid in refs[i:i+fanout]:
+                kid.get_object()[NameObject("/Parent")] = ref
+            nodes.append(ref)
+            nodeCounts.append(sum(counts[i:i+fanout]))
+        refs, counts, level = nodes, nodeCounts, level + 1
+    output._root_object[NameObject("/Pages")] = refs[0]
+    result = io.BytesIO()
+    output.write(result)
+
+    return result.getvalue()
+
+
+class PageSelectionTests(unittest.TestCase):
+    "Tests for using only some pages of a document."
+
+    def test0(self):
+        "Test parsing page selections."
+
+        self.assertEqual(list(select_pages(None, 3)), [0, 1, 2])
+        self.assertEqual(list(select_pages(slice(None, None, -2), 5)),
+                         [4, 2, 0])
+        self.assertEqual(select_pages("2,4-5", 9), [1, 3, 4])
+        self.assertEqual(select_pages("8-", 9), [7, 8])
+        self.assertEqual(select_pages("-2,3", 9), [0, 1, 2])
+        self.assertEqual(select_pages("9-1:3", 9), [8, 5, 2])
+        self.assertEqual(select_pages("1-9:4", 9), [0, 4, 8])
+        for spec in ("0", "10", "3-x", "1-5:0", "", [9]):
+            self.assertRaises(ValueError, select_pages, spec, 9)
+
+    def test1(self):
+        "Test placing a reversed range of pages."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        output = io.BytesIO()
+        numPages = generateNup(path0, n, output, pages="10-3")
+        self.assertEqual(numPages, 8)
+        sheets = PdfFileReader(output).pages
+        self.assertEqual(len(sheets), 2)
+        self.assertEqual(sheets[0].extract_text().split(),
+                         ["9", "8", "7", "6"])
+
+    def test2(self):
+        "Test only the nodes needed of a nested page tree are resolved."
+
+        pdfCode = _nestedPageTree(1000, 10)
+        reader = PdfFileReader(io.BytesIO(pdfCode))
+        self.assertEqual(pageGeometries(reader, "500"),
+                         [(0, 0, 590, 200, 90)])
+        # the kids of the nodes on the way, not all 1000 pages
+        self.assertLess(len(reader.resolved_objects), 40)
+
+        expected = [
+            (float(page.mediabox[0]), float(page.mediabox[1]),
+             float(page.mediabox[2]), float(page.mediabox[3]),
+             page.get("/Rotate", 0))
+            for page in PdfFileReader(io.BytesIO(pdfCode)).pages]
+        reader = PdfFileReader(io.BytesIO(pdfCode))
+        self.assertEqual(pageGeometries(reader), expected)
+        reader = PdfFileReader(io.BytesIO(pdfCode))
+        self.assertEqual(pageGeometries(reader, range(999, -1, -7)),
+                         expected[999::-7])
+
+    def test3(self):
+        "Test a node with as many kids as pages, not all of them pages."
+
+        output = PdfFileWriter()
+        for i in range(3):
+            output.add_page(PageObject.create_blank_page(None, 100 + i, 200))
+        p1, p2, p3 = [page.indirect_reference for page in output.pages]
+
+        def node(kids, count):
+            return output._add_object(DictionaryObject({
+                NameObject("/Type"): NameObject("/Pages"),
+                NameObject("/Kids"): ArrayObject(kids),
+                NameObject("/Count"): NumberObject(count)}))
+
+        # the root has 3 kids and 3 pages, but only one kid is a page
+        root = node([node([p1, p2], 2), p3, node([], 0)], 3)
+        output._root_object[NameObject("/Pages")] = root
+        pdfCode = io.BytesIO()
+        output.write(pdfCode)
+
+        reader = PdfFileReader(pdfCode)
+        self.assertEqual([g[2] for g in pageGeometries(reader, "2,3,1")],
+                         [101, 102, 100])
+
+
+class ProfileTests(unittest.TestCase):
+    "Tests for output profiles trading speed for size."
+
+    def test0(self):
+        "Test all profiles give the same pages, smaller ones for small."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        outputs = {}
+        for profile in ("fast", "balanced", "small"):
+            output = io.BytesIO()
+            generateNup(path0, n, output, profile=profile)
+            outputs[profile] = output.getvalue()
+            reader = PdfFileReader(io.BytesIO(output.getvalue()), strict=True)
+            self.assertEqual(len(reader.pages), math.ceil(50 / n))
+            self.assertEqual(reader.pages[1].extract_text().split(),
+                             ["4", "5", "6", "7"])
+        self.assertLess(len(outputs["balanced"]), len(outputs["fast"]))
+        self.assertLess(len(outputs["small"]), len(outputs["balanced"]))
+        self.assertIn(b"/ObjStm", outputs["small"])
+        self.assertIn(b"/XRef", outputs["small"])
+
+        output = io.BytesIO()
+        generateNup(path0, n, output, processes=2, profile="small")
+        self.assertEqual(output.getvalue(), outputs["small"])
+        self.assertRaises(ValueError, generateNup, path0, n, output,
+                          profile="tiny")
+
+    def test1(self):
+        "Test numbers in content streams are rounded to some precision."
+
+        n = (3, 1)
+        path0 = "samples/test-a4-p.pdf"
+        for precision, maxDecimals in ((None, 17), (3, 3), (0, 0)):
+            output = io.BytesIO()
+            generateNup(path0, n, output, precision=precision)
+            reader = PdfFileReader(output)
+            code = reader.pages[0]["/Contents"].get_object().get_data()
+            nums = code.split()[1:7]
+            decimals = max(len(x.partition(b".")[2]) for x in nums)
+            self.assertLessEqual(decimals, maxDecimals)
+            self.assertNotIn(b"e", b"".join(nums))
+        self.assertEqual(pdfnup._formatNumber(1e-5), "0.00001")
+        self.assertEqual(pdfnup._formatNumber(-1e-5, 3), "0")
+        self.assertEqual(pdfnup._formatNumber(0.5, 3), "0.5")
+
+
+class SheetCacheTests(unittest.TestCase):
+    "Tests for reusing sheets of unchanged pages from a cache."
+
+    def test0(self):
+        "Test only the sheet showing an edited page is composed again."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        output = PdfFileWriter()
+        for page in PdfFileReader(path0).pages:
+            output.add_page(page)
+        original = io.BytesIO()
+        output.write(original)
+        contents = DecodedStreamObject()
+        contents.set_data(b"BT /F1 24 Tf 100 100 Td (edited) Tj ET")
+        page = output.pages[21]
+        page[NameObject("/Contents")] = output._add_object(contents)
+        edited = io.BytesIO()
+        output.write(edited)
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            for input, misses in ((original, 13), (original, 0), (edited, 1)):
+                cache = SheetCache(tmpDir)
+                collector = TraceCollector()
+                result = io.BytesIO()
+                generateNup(input.getvalue(), n, result, cache=cache,
+                            on_event=collector)
+                self.assertEqual(cache.misses, misses)
+                self.assertEqual(cache.hits, 13 - misses)
+                self.assertEqual(len(cache), 13 + (input is edited))
+                cached = [event["cached"] for event in collector.to_json()
+                          if event["name"] == "sheet"]
+                self.assertEqual(cached.count(False), misses)
+
+                expected = io.BytesIO()
+                generateNup(input.getvalue(), n, expected)
+                reader = PdfFileReader(result, strict=True)
+                expectedReader = PdfFileReader(expected)
+                self.assertEqual(len(reader.pages), 13)
+                for i in (0, 5, 12):
+                    self.assertEqual(reader.pages[i].extract_text(),
+                                     expectedReader.pages[i].extract_text())
+            self.assertIn("edited", reader.pages[5].extract_text())
+
+    def test1(self):
+        "Test the least recently used entries are removed first."
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            cache = SheetCache(tmpDir, max_size=25)
+            cache.put("a", bytes(10))
+            cache.put("b", bytes(10))
+            self.assertEqual(cache.get("a"), bytes(10))
+            cache.put("c", bytes(10))
+            self.assertIsNone(cache.get("b"))
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            self.assertEqual(sorted(os.listdir(tmpDir)),
+                             ["a.sheet", "c.sheet"])
+            cache = SheetCache(tmpDir, max_size=25)
+            self.assertEqual((len(cache), cache.size), (2, 20))
+
+    def test2(self):
+        "Test damaged entries are composed again, also with object streams."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        expected = io.BytesIO()
+        generateNup(path0, n, expected, profile="small")
+        with tempfile.TemporaryDirectory() as tmpDir:
+            generateNup(path0, n, io.BytesIO(), cache=tmpDir, profile="small")
+            for name in os.listdir(tmpDir)[:3]:
+                with open(os.path.join(tmpDir, name), "wb") as f:
+                    f.write(b"junk")
+            cache = SheetCache(tmpDir)
+            result = io.BytesIO()
+            generateNup(path0, n, result, cache=cache, profile="small")
+            self.assertEqual(cache.hits, 13)
+        self.assertIn(b"/ObjStm", result.getvalue())
+        reader = PdfFileReader(result, strict=True)
+        expectedReader = PdfFileReader(expected)
+        for i in range(13):
+            self.assertEqual(reader.pages[i].extract_text(),
+                             expectedReader.pages[i].extract_text())
+
+
+class _Pipe(io.BytesIO):
+    "A non-seekable stream, like a pipe."
+
+    def seekable(self):
+        return False
+
+
+class MultiInputTests(unittest.TestCase):
+    "Tests for laying out the pages of several inputs on the same sheets."
+
+    def test0(self):
+        "Test pages flow across inputs and their fonts are written once."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        path1 = "samples/test-a4-p.pdf"
+        with open(path1, "rb") as file:
+            pdfCode = file.read()
+        for kwargs in ({}, {"streaming": True, "max_open": 1},
+                       {"profile": "small"}):
+            inputs = [path0, pdfCode, _Pipe(pdfCode), path0]
+            output = io.BytesIO()
+            numPages = generateNup(inputs, n, output, pages="1-:2", **kwargs)
+            self.assertEqual(numPages, 100)
+            reader = PdfFileReader(output, strict=True)
+            self.assertEqual(len(reader.pages), 25)
+            self.assertEqual(reader.pages[6].extract_text().split(),
+                             ["48", "0", "2", "4"])
+            fontRefs = set()
+            for page in reader.pages:
+                for form in page["/Resources"]["/XObject"].values():
+                    fonts = form.get_object()["/Resources"]["/Font"]
+                    fontRefs.update(
+                        dict.__getitem__(fonts, k).idnum for k in fonts)
+            self.assertEqual(len(fontRefs), 1)
+
+        self.assertRaises(AssertionError, generateNup, [path0, path1], n)
+        self.assertRaises(ValueError, generateNup, [], n, io.BytesIO())
+
+    def test1(self):
+        "Test inputs are opened again after closing them."
+
+        path0 = "samples/test-a4-l.pdf"
+        with open(path0, "rb") as file:
+            pdfCode = file.read()
+        inputs = [path0, _Pipe(pdfCode), pdfCode]
+        with pdfnup._InputPages(inputs, maxOpen=2) as pages:
+            self.assertEqual(len(pages), 150)
+            for num in (0, 50, 100, 0, 149, 51):
+                page = pages[num]
+                self.assertEqual(page.extract_text().split()[0],
+                                 str(num % 50))
+                self.assertLessEqual(len(pages.open), 2)
+                self.assertEqual(len(pages.sources), len(pages.open))
+            self.assertEqual(pages.offsets[1], pages.firstNum // 3)
+        self.assertEqual(len(pages.open), 0)
+
+
+class IterSheetsTests(unittest.TestCase):
+    "Tests for yielding sheets one at a time."
+
+    def test0(self):
+        "Test the first sheet needs only its pages and all match."
+
+        n = 4
+        pdfCode = _nestedPageTree(1000, 10)
+        findPage = pdfnup._PageTree._find
+        with unittest.mock.patch.object(pdfnup._PageTree, "_find",
+                                        autospec=True,
+                                        side_effect=findPage) as find:
+            sheets = iter_nup_sheets(pdfCode, n, fit=True)
+            next(sheets)
+            found = {call.args[1] for call in find.call_args_list}
+            self.assertEqual(found, set(range(n)))
+        sheets.close()
+
+        output = io.BytesIO()
+        generateNup(pdfCode, n, output, fit=True)
+        expected = PdfFileReader(output).pages
+        writer = PdfFileWriter()
+        for sheet in iter_nup_sheets(pdfCode, n, fit=True):
+            writer.add_page(sheet)
+        output = io.BytesIO()
+        writer.write(output)
+        sheets = PdfFileReader(output).pages
+        self.assertEqual(len(sheets), 250)
+        for sheet, expectedSheet in zip(sheets, expected):
+            self.assertEqual(sheet.get_contents().get_data(),
+                             expectedSheet.get_contents().get_data())
+
+    def test1(self):
+        "Test yielding sheets as single page documents."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        sheets = list(iter_nup_sheets(path0, n, pages="5-", output="pdf",
+                                      profile="small"))
+        self.assertEqual(len(sheets), 12)
+        for i, data in enumerate(sheets):
+            reader = PdfFileReader(io.BytesIO(data), strict=True)
+            self.assertEqual(len(reader.pages), 1)
+            self.assertEqual(reader.pages[0].extract_text().split(),
+                             [str(k) for k in range(i*n + 4, 50)][:n])
+            self.assertIn(b"/ObjStm", data)
+
+        self.assertRaises(ValueError, list,
+                          iter_nup_sheets(path0, n, output="png"))
+
+    def test2(self):
+        "Test sheets can be pickled, like pages, e.g. for other processes."
+
+        sheet = next(iter_nup_sheets("samples/test-a4-l.pdf", 4))
+        self.assertTrue(pickle.dumps(sheet))
+        names = list(sheet["/Resources"]["/XObject"])
+        copies = pickle.loads(pickle.dumps(names))
+        self.assertEqual(copies, names)
+        self.assertEqual([type(name) for name in copies],
+                         [type(name) for name in names])
+
+
+class CommandLineTests(unittest.TestCase):
+    "Tests for the pdfnup command-line tool."
+
+    def test0(self):
+        "Test stdin and stdout, directories, globs and missing files."
+
+        path0 = "samples/test-a4-l.pdf"
+        script = os.path.abspath("pdfnup")
+        with open(path0, "rb") as file:
+            pdfCode = file.read()
+        env = dict(os.environ, PYTHONPATH=os.path.abspath("."))
+        with tempfile.TemporaryDirectory() as tmpDir:
+            proc = subprocess.run([sys.executable, script, "-n", "2", "-"],
+                                  input=pdfCode, capture_output=True,
+                                  cwd=tmpDir, env=env, check=True)
+            self.assertEqual(len(PdfFileReader(io.BytesIO(proc.stdout)).pages),
+                             25)
+
+            os.makedirs(os.path.join(tmpDir, "a", "b"))
+            for name in ("a/1.pdf", "a/b/2.pdf", "a/b/3.pdf"):
+                with open(os.path.join(tmpDir, name), "wb") as file:
+                    file.write(pdfCode)
+            proc = subprocess.run(
+                [sys.executable, script, "a", "a/**/3.pdf", "missing.pdf"],
+                capture_output=True, text=True, cwd=tmpDir, env=env)
+            self.assertEqual(proc.returncode, 1)
+            self.assertIn("failed: missing.pdf", proc.stderr)
+            self.assertEqual(proc.stdout, "")
+            for name in ("a/1-4up.pdf", "a/b/3-4up.pdf"):
+                self.assertTrue(os.path.exists(os.path.join(tmpDir, name)))
+            self.assertFalse(os.path.exists(
+                os.path.join(tmpDir, "a/b/2-4up.pdf")))
+
+
+class TraceTests(unittest.TestCase):
+    "Tests for reporting the phases of generating a document."
+
+    def test0(self):
+        "Test all phases and sheets are reported with sizes."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        for streaming in (False, True):
+            collector = TraceCollector()
+            output = io.BytesIO()
+            generateNup(path0, n, output, streaming=streaming,
+                        on_event=collector)
+            events = collector.to_json()
+            names = [e["name"] for e in events]
+            numSheets = math.ceil(50 / n)
+            self.assertEqual(names.count("sheet"), numSheets)
+            self.assertEqual(
+                [name for name in names if name != "sheet"],
+                ["read", "plan", "compose", "write"])
+            self.assertEqual(events[0]["bytes"], os.path.getsize(path0))
+            self.assertEqual(events[0]["pages"], 50)
+            self.assertEqual(events[-1]["bytes"], len(output.getvalue()))
+            for e in events:
+                self.assertGreaterEqual(e["duration"], 0)
+
+    def test1(self):
+        "Test exporting a Chrome trace."
+
+        collector = TraceCollector()
+        generateNup("samples/test-a4-l.pdf", 4, io.BytesIO(),
+                    on_event=collector)
+        with tempfile.TemporaryDirectory() as tmpDir:
+            path = os.path.join(tmpDir, "trace.json")
+            collector.write_chrome_trace(path)
+            with open(path) as file:
+                trace = json.load(file)
+        events = trace["traceEvents"]
+        self.assertEqual(len(events), len(collector.events))
+        self.assertTrue(all(e["ph"] == "X" for e in events))
+        self.assertEqual(min(e["ts"] for e in events), 0)
+
+
+class OutputSpoolTests(unittest.TestCase):
+    "Tests for output buffers spilling to disk."
+
+    def test0(self):
+        "Test spilling, copying by the kernel and removing the file."
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            spool = OutputSpool(max_memory=10, dir=tmpDir)
+            spool.write(b"1234")
+            self.assertIsNone(spool.name)
+            spool.write(b"56789abcdef")
+            self.assertTrue(os.path.exists(spool.name))
+            self.assertEqual(spool.size, 15)
+            spool.seek(4)
+            self.assertEqual(spool.read(3), b"567")
+
+            path = os.path.join(tmpDir, "out.bin")
+            with open(path, "wb") as file:
+                file.write(b"<")
+                spool.sendfile(file)
+                self.assertEqual(file.tell(), 16)
+                file.write(b">")
+            with open(path, "rb") as file:
+                self.assertEqual(file.read(), b"<123456789abcdef>")
+            output = io.BytesIO()
+            spool.sendfile(output)
+            self.assertEqual(output.getvalue(), spool.getvalue())
+            spool.close()
+            self.assertEqual(os.listdir(tmpDir), ["out.bin"])
+
+            spool = OutputSpool(max_memory=10, dir=tmpDir)
+            spool.write(b"x" * 20)
+            spool = OutputSpool._adopt(spool.release())
+            self.assertEqual(spool.read(), b"x" * 20)
+            spool.close()
+            self.assertEqual(os.listdir(tmpDir), ["out.bin"])
+
+    def test1(self):
+        "Test large outputs of server jobs are spooled to disk."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        with open(path0, "rb") as file:
+            pdfCode = file.read()
+        expected = io.BytesIO()
+        generateNup(pdfCode, n, expected)
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            address = os.path.join(tmpDir, "nup.sock")
+            with NupServer(address, workers=1, max_memory=1024) as server:
+                thread = threading.Thread(target=server.serve_forever)
+                thread.start()
+                try:
+                    output, numPages = nup_remote(address, pdfCode, n)
+                finally:
+                    server.shutdown()
+                    thread.join()
+        self.assertEqual(numPages, 50)
+        self.assertEqual(output, expected.getvalue())
+
+
+class HotFolderTests(unittest.TestCase):
+    "Tests for processing files dropped into a directory."
+
+    def run_folder(self, folder, numResults, results):
+        thread = threading.Thread(target=folder.serve_forever)
+        thread.start()
+        try:
+            for i in range(100):
+                if len(results) >= numResults:
+                    break
+                time.sleep(0.1)
+        finally:
+            folder.shutdown()
+            thread.join()
+
+    def test0(self):
+        "Test files are processed once, after being written completely."
+
+        path0 = "samples/test-a4-l.pdf"
+        with open(path0, "rb") as file:
+            pdfCode = file.read()
+        with tempfile.TemporaryDirectory() as tmpDir:
+            watchDir = os.path.join(tmpDir, "in")
+            outDir = os.path.join(tmpDir, "out")
+            os.mkdir(watchDir)
+            with open(os.path.join(watchDir, "a.pdf"), "wb") as file:
+                file.write(pdfCode)
+            results = []
+            with HotFolder(watchDir, outDir, 2, workers=2, settle=0.3,
+                           poll_interval=0.05,
+                           on_result=lambda *r: results.append(r)) as folder:
+                thread = threading.Thread(target=self.run_folder,
+                                          args=(folder, 3, results))
+                thread.start()
+                # a file written slowly, which must not be taken early
+                with open(os.path.join(watchDir, "b.pdf"), "wb") as file:
+                    for i in range(0, len(pdfCode), len(pdfCode) // 4):
+                        file.write(pdfCode[i:i + len(pdfCode) // 4])
+                        file.flush()
+                        time.sleep(0.1)
+                with open(os.path.join(watchDir, "bad.pdf"), "wb") as file:
+                    file.write(b"junk")
+                with open(os.path.join(watchDir, "c.txt"), "wb") as file:
+                    file.write(b"junk")
+                thread.join()
+                stats = folder.stats()
+            self.assertEqual(sorted(os.listdir(outDir)),
+                             ["a-2up.pdf", "b-2up.pdf"])
+            for name in ("a-2up.pdf", "b-2up.pdf"):
+                reader = PdfFileReader(os.path.join(outDir, name))
+                self.assertEqual(len(reader.pages), 25)
+            self.assertEqual(sorted((os.path.basename(r[0]), r[2])
+                                    for r in results),
+                             [("a.pdf", 50), ("b.pdf", 50), ("bad.pdf", 0)])
+            self.assertEqual(stats["completed"], 3)
+            self.assertEqual(stats["failed"], 1)
+            self.assertEqual(stats["pages"], 100)
+            self.assertEqual(stats["backlog"], 0)
+
+            # outputs newer than their inputs are not made again
+            results = []
+            with HotFolder(watchDir, outDir, 2, workers=1, settle=0.1,
+                           poll_interval=0.05,
+                           on_result=lambda *r: results.append(r)) as folder:
+                self.run_folder(folder, 1, results)
+                stats = folder.stats()
+            self.assertEqual(stats["skipped"], 2)
+            self.assertEqual([os.path.basename(r[0]) for r in results],
+                             ["bad.pdf"])
+
+            self.assertRaises(ValueError, HotFolder, watchDir, watchDir)
+
+    def test1(self):
+        "Test files processed are not settled again when polling."
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            watchDir = os.path.join(tmpDir, "in")
+            outDir = os.path.join(tmpDir, "out")
+            os.mkdir(watchDir)
+            path = os.path.join(watchDir, "a.pdf")
+            with open("samples/test-a4-l.pdf", "rb") as file:
+                with open(path, "wb") as output:
+                    output.write(file.read())
+            results = []
+            with unittest.mock.patch.object(pdfnup, "_inotify",
+                                            return_value=None):
+                folder = HotFolder(watchDir, outDir, 2, workers=1,
+                                   settle=0.1, poll_interval=0.05,
+                                   on_result=lambda *r: results.append(r))
+            with folder:
+                self.run_folder(folder, 1, results)
+                self.assertEqual(folder.stats()["watching"], "polling")
+                for i in range(3):
+                    folder._tick()
+                    self.assertEqual(folder.stats()["settling"], 0)
+
+                # changed files are settled and processed again
+                stat = os.stat(path)
+                os.utime(path, ns=(stat.st_atime_ns,
+                                   stat.st_mtime_ns + 10**9))
+                folder._tick()
+                self.assertEqual(folder.stats()["settling"], 1)
+            self.assertEqual(len(results), 1)
+
+    def test2(self):
+        "Test files changed while queued or in flight are done again."
+
+        path0 = "samples/test-a4-l.pdf"
+        with tempfile.TemporaryDirectory() as tmpDir:
+            watchDir = os.path.join(tmpDir, "in")
+            outDir = os.path.join(tmpDir, "out")
+            os.mkdir(watchDir)
+            path = os.path.join(watchDir, "a.pdf")
+            with open(path0, "rb") as file:
+                with open(path, "wb") as output:
+                    output.write(file.read())
+            results = []
+            with HotFolder(watchDir, outDir, 2, workers=1, settle=0,
+                           on_result=lambda *r: results.append(r)) as folder:
+                folder._notice(["a.pdf"])
+                folder._check(0)
+                folder._check(1)
+                folder._dispatch()
+                self.assertEqual(folder.stats()["in_flight"], 1)
+
+                # replaced by a 2 page version while being processed
+                writer = PdfFileWriter()
+                for page in PdfFileReader(path0).pages[:2]:
+                    writer.add_page(page)
+                with open(path, "wb") as output:
+                    writer.write(output)
+                while folder.inFlight:
+                    folder._collect(None)
+                self.assertEqual(folder.stats()["settling"], 1)
+
+                folder._check(2)
+                folder._check(3)
+                folder._dispatch()
+                while folder.inFlight:
+                    folder._collect(None)
+            # the first job may have read either version, or failed
+            self.assertEqual(len(results), 2)
+            path1, outPath, numPages, duration, error = results[1]
+            self.assertEqual((numPages, error), (2, None))
+            reader = PdfFileReader(os.path.join(outDir, "a-2up.pdf"))
+            self.assertEqual(len(reader.pages), 1)
+
+
+class ServerTests(unittest.TestCase):
+    "Tests for serving jobs with warm worker processes."
+
+    def test0(self):
+        "Test jobs, failures and statistics through a Unix-domain socket."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        with open(path0, "rb") as file:
+            pdfCode = file.read()
+        expected = io.BytesIO()
+        generateNup(pdfCode, n, expected, pages="1-9", profile="balanced")
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            address = os.path.join(tmpDir, "nup.sock")
+            with NupServer(address, workers=1) as server:
+                thread = threading.Thread(target=server.serve_forever)
+                thread.start()
+                try:
+                    output, numPages = nup_remote(
+                        address, pdfCode, n, pages="1-9", profile="balanced")
+                    self.assertEqual(numPages, 9)
+                    self.assertEqual(output, expected.getvalue())
+                    self.assertRaises(
+                        RuntimeError, nup_remote, address, b"junk", n)
+                    stats = nup_server_stats(address)
+                finally:
+                    server.shutdown()
+                    thread.join()
+            self.assertFalse(os.path.exists(address))
+        self.assertEqual(stats["completed"], 2)
+        self.assertEqual(stats["failed"], 1)
+        self.assertEqual(stats["queue_depth"], 0)
+        self.assertGreater(stats["latency_max"], 0)
+
+    def test1(self):
+        "Test parsing server addresses."
+
+        parse = pdfnup._parseAddress
+        self.assertEqual(parse("8080"), (socket.AF_INET, ("127.0.0.1", 8080)))
+        self.assertEqual(parse("localhost:80"),
+                         (socket.AF_INET, ("localhost", 80)))
+        self.assertEqual(parse("/tmp/nup.sock"),
+                         (socket.AF_UNIX, "/tmp/nup.sock"))
+        self.assertEqual(parse("/tmp/nup:1"), (socket.AF_UNIX, "/tmp/nup:1"))
+
+    def test2(self):
+        "Test servers stay local and refuse too large messages."
+
+        self.assertTrue(pdfnup._isLoopback("localhost"))
+        self.assertTrue(pdfnup._isLoopback("127.0.0.2"))
+        self.assertFalse(pdfnup._isLoopback("0.0.0.0"))
+        self.assertRaises(ValueError, NupServer, "0.0.0.0:0")
+
+        def message(header, body=b""):
+            header = json.dumps(header).encode()
+            return io.BytesIO(len(header).to_bytes(4, "big") + header + body)
+
+        recv = pdfnup._recvMessage
+        self.assertEqual(recv(message({"size": 3}, b"abc"), 3),
+                         ({"size": 3}, b"abc"))
+        self.assertRaises(ValueError, recv, message({"size": 1 << 40}), 3)
+        self.assertRaises(ValueError, recv, message({"size": -1}))
+        self.assertRaises(ValueError, recv,
+                          message({"junk": "x" * (1 << 17)}))
+
+
+    def test3(self):
+        "Test only stale sockets of other servers are removed."
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            path = os.path.join(tmpDir, "keep.txt")
+            with open(path, "w") as file:
+                file.write("keep")
+            self.assertRaises(FileExistsError, NupServer, path, workers=1)
+            with open(path) as file:
+                self.assertEqual(file.read(), "keep")
+
+            address = os.path.join(tmpDir, "nup.sock")
+            with NupServer(address, workers=1):
+                self.assertRaises(FileExistsError,
+                                  NupServer, address, workers=1)
+                self.assertTrue(os.path.exists(address))
+            self.assertFalse(os.path.exists(address))
+
+            # left behind by a server which has gone away
+            with socket.socket(socket.AF_UNIX) as sock:
+                sock.bind(address)
+            with NupServer(address, workers=1) as server:
+                thread = threading.Thread(target=server.serve_forever)
+                thread.start()
+                try:
+                    stats = nup_server_stats(address)
+                finally:
+                    server.shutdown()
+                    thread.join()
+            self.assertEqual(stats["submitted"], 0)
+
+
+class AsyncTests(unittest.IsolatedAsyncioTestCase):
+    "Tests for generating N-up documents from asyncio code."
+
+    async def collect(self, source, n, **kwargs):
+        chunks = []
+        async for chunk in generate_nup_async(source, n, **kwargs):
+            chunks.append(chunk)
+        return chunks
+
+    async def test0(self):
+        "Test chunks from bytes equal the streamed document."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        with open(path0, "rb") as file:
+            pdfCode = file.read()
+        expected = io.BytesIO()
+        generateNup(io.BytesIO(pdfCode), n, expected, streaming=True)
+        chunks = await self.collect(pdfCode, n, chunk_size=4096)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b"".join(chunks), expected.getvalue())
+
+    async def test1(self):
+        "Test reading from an async stream and composing in a process."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        with open(path0, "rb") as file:
+            pdfCode = file.read()
+        stream = asyncio.StreamReader()
+        stream.feed_data(pdfCode)
+        stream.feed_eof()
+        with concurrent.futures.ProcessPoolExecutor(1) as executor:
+            chunks = await self.collect(stream, n, executor=executor)
+        np0 = len(PdfFileReader(path0).pages)
+        result = PdfFileReader(io.BytesIO(b"".join(chunks)))
+        self.assertEqual(len(result.pages), math.ceil(np0 / n))
+
+    async def test2(self):
+        "Test errors are raised and abandoned iterators stop composing."
+
+        with self.assertRaises(Exception):
+            await self.collect(b"junk", 4)
+
+        path0 = "samples/test-a4-l.pdf"
+        with open(path0, "rb") as file:
+            pdfCode = file.read()
+        limiter = asyncio.Semaphore(1)
+        errors = []
+        loop = asyncio.get_running_loop()
+        loop.set_exception_handler(lambda loop, context: errors.append(
+            context["message"]))
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        chunks = generate_nup_async(pdfCode, 4, executor=executor,
+                                    limiter=limiter, chunk_size=1024)
+        await chunks.__anext__()
+        await chunks.aclose()
+        # the limiter is released once the producer has stopped, and its
+        # error is not reported as never retrieved
+        await loop.run_in_executor(None, executor.shutdown)
+        for i in range(3):
+            await asyncio.sleep(0)
+        self.assertFalse(limiter.locked())
+        del chunks
+        gc.collect()
+        self.assertEqual(errors, [])
+
+    async def test3(self):
+        "Test large output of a process is passed back in a file."
+
+        n = 4
+        path0 = "samples/test-a4-l.pdf"
+        with open(path0, "rb") as file:
+            pdfCode = file.read()
+        expected = io.BytesIO()
+        generateNup(io.BytesIO(pdfCode), n, expected)
+        with concurrent.futures.ProcessPoolExecutor(1) as executor:
+            chunks = await self.collect(pdfCode, n, executor=executor,
+                                        spool_memory=1024,
+                                        chunk_size=4096)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b"".join(chunks), expected.getvalue())
+
+    async def test4(self):
+        "Test the file of output nobody reads any more is removed."
+
+        path0 = "samples/test-a4-l.pdf"
+        with open(path0, "rb") as file:
+            pdfCode = file.read()
+        with tempfile.TemporaryDirectory() as tmpDir:
+            with unittest.mock.patch.object(tempfile, "tempdir", tmpDir), \
+                    concurrent.futures.ProcessPoolExecutor(1) as executor:
+                limiter = asyncio.Semaphore(1)
+                chunks = generate_nup_async(pdfCode, 4, executor=executor,
+                                            limiter=limiter, spool_memory=100)
+                task = asyncio.ensure_future(chunks.__anext__())
+                # cancelled while waiting for the job
+                for i in range(3):
+                    await asyncio.sleep(0)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+                await chunks.aclose()
+                async with limiter:
+                    # the job is done
+                    pass
+                for i in range(3):
+                    await asyncio.sleep(0)
+            self.assertEqual(os.listdir(tmpDir), [])
+
+
 if __name__ == "__main__":
     unittest.main()